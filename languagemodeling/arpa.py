@@ -0,0 +1,149 @@
+"""Import and export of n-gram models in ARPA format.
+
+In an ARPA file each listed k-gram x1..xk has its log10 probability
+P(xk | x1..xk-1) and, for k < n, the log10 back-off weight w(x1..xk). The
+probability of an unlisted n-gram is w(x1..xk-1) * P(xk | x2..xk-1), with
+w = 1 for unlisted contexts.
+"""
+from array import array
+from math import log10
+import re
+
+from languagemodeling.counts import SENT_START, SENT_END, Vocabulary, \
+    CountTable, id_bits
+
+UNK = '<unk>'
+LOG_ZERO = -99.  # log10 of probability 0, by convention
+
+NGRAM_SIZE_RE = re.compile(r'ngram\s+(\d+)\s*=\s*(\d+)$')
+SECTION_RE = re.compile(r'\\(\d+)-grams:$')
+
+
+def _format_log10(x):
+    if x <= 0.:
+        return '%g' % LOG_ZERO
+    return '%.7g' % log10(x)
+
+
+def _parse_log10(field):
+    value = float(field)
+    if value <= LOG_ZERO:
+        return float('-inf')
+    return value
+
+
+def write_arpa(model, f):
+    """Write a model in ARPA format.
+
+    The model must have a backoff_weight() method, as InterpolatedNGram and
+    BackOffNGram do. Every k-gram seen in training is listed, and every token
+    of the vocabulary as a unigram. A BackOffNGram with beta = 0 gives
+    probability 0 to everything after an unseen context, which ARPA can't
+    express: the file backs off to the shorter context instead.
+
+    model -- the n-gram model.
+    f -- text file object.
+    """
+    n = model.n
+    vocab = model.vocab
+    sizes = [len(vocab)] + [len(model.counts.keys.get(order, ()))
+                            for order in range(2, n + 1)]
+
+    f.write('\\data\\\n')
+    for order, size in enumerate(sizes, 1):
+        f.write('ngram %d=%d\n' % (order, size))
+
+    for order in range(1, n + 1):
+        f.write('\n\\%d-grams:\n' % order)
+        if order == 1:
+            ngrams = ((i,) for i in range(len(vocab)))
+        else:
+            ngrams = (ids for ids, _ in model.counts.id_items(order))
+        for ids in ngrams:
+            tokens = vocab.decode(ids)
+            prob = model.cond_prob(tokens[-1], tokens[:-1])
+            line = '%s\t%s' % (_format_log10(prob), ' '.join(tokens))
+            if order < n:
+                weight = model.backoff_weight(tokens)
+                if weight != 1.:
+                    line += '\t%s' % _format_log10(weight)
+            f.write(line + '\n')
+
+    f.write('\n\\end\\\n')
+
+
+def read_arpa(f):
+    """Read a model in ARPA format, in a single pass.
+
+    f -- text file object.
+
+    Returns the order of the model, the Vocabulary and two CountTables of
+    doubles, with the log10 probabilities and the log10 back-off weights.
+    """
+    vocab = Vocabulary([SENT_START, SENT_END])
+    sizes = {}
+    log_probs = CountTable(vocab, typecode='d')
+    log_bows = CountTable(vocab, typecode='d')
+    order = None
+    entries = None
+
+    def store(order, entries):
+        keys, probs, bow_keys, bows = entries
+        if len(keys) != sizes.get(order):
+            raise ValueError('Wrong number of %d-grams' % order)
+        if order == 1:
+            # the vocabulary is complete now
+            log_probs.bits = log_bows.bits = id_bits(len(vocab))
+        log_probs.set_order(order, keys, probs)
+        log_bows.set_order(order, bow_keys, bows)
+
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('\\'):
+            if entries is not None:
+                store(order, entries)
+                entries = None
+            if line == '\\end\\':
+                break
+            elif line == '\\data\\':
+                order = 0
+                continue
+            match = SECTION_RE.match(line)
+            if match is None or order is None:
+                raise ValueError('Unexpected line: %s' % line)
+            order = int(match.group(1))
+            if order > 1 and 1 not in log_probs.keys:
+                raise ValueError('%d-grams before the unigrams' % order)
+            entries = ([], array('d'), [], array('d'))
+        elif order == 0:
+            match = NGRAM_SIZE_RE.match(line)
+            if match is None:
+                raise ValueError('Unexpected line: %s' % line)
+            sizes[int(match.group(1))] = int(match.group(2))
+        elif entries is not None:
+            fields = line.split()
+            if len(fields) not in (order + 1, order + 2):
+                raise ValueError('Malformed %d-gram: %s' % (order, line))
+            if order == 1:
+                # the packed key of a unigram is its id
+                key = vocab.add(fields[1])
+            else:
+                ids = vocab.encode(fields[1: order + 1])
+                if ids is None:
+                    raise ValueError('Unknown token in %s' % line)
+                key = log_probs.pack(ids)
+            entries[0].append(key)
+            entries[1].append(_parse_log10(fields[0]))
+            if len(fields) == order + 2:
+                entries[2].append(key)
+                entries[3].append(_parse_log10(fields[-1]))
+        else:
+            raise ValueError('Unexpected line: %s' % line)
+    else:
+        raise ValueError('Missing \\end\\')
+
+    if not sizes:
+        raise ValueError('Missing \\data\\ section')
+    return max(sizes), vocab, log_probs, log_bows
@@ -0,0 +1,1080 @@
+"""Compact storage for n-gram counts.
+
+Tokens are mapped to integer ids by a Vocabulary. The n-grams of each order
+are kept in a CountTable as a sorted array of packed integer keys (the ids of
+the n-gram, first token in the most significant bits) with a parallel array of
+counts. All the n-grams sharing a prefix are contiguous in the key array.
+Each id takes at least 16 bits, and a multiple of 4, so that the packing
+rarely changes as the vocabulary grows.
+
+While counting, the n-grams are packed the same way into the keys of a
+Counter per order (PackedCounts), so that the keys of a whole sentence are
+computed and counted by C loops (map and Counter.update) and the table is
+built by sorting integers.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping
+from heapq import merge as heap_merge
+from itertools import chain, compress, islice, repeat
+from multiprocessing import Pool, Process, Queue
+from queue import Empty
+from operator import add, and_, eq, getitem, is_, lshift, mod, or_, rshift
+import os
+from tempfile import NamedTemporaryFile, TemporaryFile
+
+SENT_START = '<s>'
+SENT_END = '</s>'
+
+
+class Vocabulary(object):
+
+    def __init__(self, tokens=()):
+        """
+        tokens -- initial tokens, they get the first ids in order.
+        """
+        self.ids = {}
+        self.tokens = []
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.ids
+
+    def add(self, token):
+        """Id of a token, adding it to the vocabulary if it is new.
+
+        token -- the token.
+        """
+        try:
+            return self.ids[token]
+        except KeyError:
+            i = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            return i
+
+    def encode(self, tokens):
+        """Tuple of ids of a sequence of tokens (None if some is unknown).
+
+        tokens -- the sequence of tokens.
+        """
+        ids = self.ids
+        try:
+            return tuple([ids[token] for token in tokens])
+        except KeyError:
+            return None
+
+    def decode(self, ids):
+        """Tuple of tokens of a sequence of ids.
+
+        ids -- the sequence of ids.
+        """
+        tokens = self.tokens
+        return tuple([tokens[i] for i in ids])
+
+
+def id_bits(size):
+    """Number of bits of each id in the packed keys for a vocabulary.
+
+    size -- size of the vocabulary.
+    """
+    bits = 16
+    while size > 1 << bits:
+        bits += 4
+    return bits
+
+
+def _pack(columns, bits):
+    """Iterator of the packed keys of n-grams given by the columns of their
+    ids, from the first token to the last one (at least one column).
+    """
+    keys = None
+    for column in columns:
+        if keys is None:
+            keys = column
+        else:
+            keys = map(or_, map(lshift, keys, repeat(bits)), column)
+    return keys
+
+
+def _unpack(keys, order, bits):
+    """Columns of ids of a list of packed keys, from the first token to the
+    last one.
+    """
+    mask = (1 << bits) - 1
+    return [list(map(and_, map(rshift, keys, repeat(bits * (order - j - 1))),
+                     repeat(mask)))
+            for j in range(order)]
+
+
+def _unpack_ids(keys, order, bits):
+    """Iterator of the tuples of ids of a list of packed keys."""
+    if not order:
+        return repeat((), len(keys))
+    return zip(*_unpack(keys, order, bits))
+
+
+def _repack(keys, order, bits, new_bits):
+    """List of packed keys with another number of bits per id, in the same
+    order (they compare the same).
+    """
+    if not order or bits == new_bits:
+        return keys
+    return list(_pack(_unpack(keys, order, bits), new_bits))
+
+
+class PackedCounts(Mapping):
+    """Counts of n-grams while they are counted, in a Counter per order
+    keyed by packed keys.
+
+    The vocabulary grows while counting, so the keys are packed again in the
+    rare case it outgrows the bits of each id (see id_bits). As a Mapping,
+    the counts are keyed by tuples of ids.
+    """
+
+    def __init__(self, size=0):
+        """
+        size -- initial size of the vocabulary.
+        """
+        self.bits = id_bits(size)
+        self.orders = defaultdict(Counter)
+
+    def reserve(self, size):
+        """Make room for the ids of a vocabulary, packing the keys again if
+        they don't fit. Returns the number of bits of each id.
+
+        size -- size of the vocabulary.
+        """
+        bits = id_bits(size)
+        if bits > self.bits:
+            for order, counts in list(self.orders.items()):
+                keys = _repack(list(counts), order, self.bits, bits)
+                self.orders[order] = Counter()
+                dict.update(self.orders[order], zip(keys, counts.values()))
+            self.bits = bits
+        return self.bits
+
+    def add(self, ids, count):
+        """Add to the count of a tuple of ids, that fit in the bits.
+        """
+        key = 0
+        for i in ids:
+            key = key << self.bits | i
+        self.orders[len(ids)][key] += count
+
+    def add_keys(self, order, keys, values, bits, ids=None):
+        """Add the counts of packed keys of an order.
+
+        order -- the order of the keys.
+        keys -- list of packed keys, without repeats.
+        values -- parallel sequence of counts.
+        bits -- number of bits of each id in the keys.
+        ids -- if given, list mapping the ids in the keys to the ids of these
+            counts.
+        """
+        if order and (ids is not None or bits != self.bits):
+            columns = _unpack(keys, order, bits)
+            if ids is not None:
+                columns = [map(ids.__getitem__, c) for c in columns]
+            keys = _pack(columns, self.bits)
+        counts = self.orders[order]
+        if len(counts) < len(values):
+            # the smaller side is added in Python, the other one copied in C
+            added, counts = counts, Counter()
+            dict.update(counts, zip(keys, values))
+            self.orders[order] = counts
+            keys, values = added.keys(), added.values()
+        for key, count in zip(keys, values):
+            counts[key] += count
+
+    def merge(self, other, ids=None):
+        """Add the counts of other PackedCounts.
+
+        other -- the PackedCounts.
+        ids -- if given, list mapping the ids of other to the ids of these
+            counts.
+        """
+        for order, counts in other.orders.items():
+            self.add_keys(order, list(counts), list(counts.values()),
+                          other.bits, ids)
+
+    def add_disjoint(self, other):
+        """Add the counts of other PackedCounts with the same bits and no
+        n-gram in common with these, copying them in C.
+        """
+        if other.bits != self.bits:
+            raise ValueError('Different bits: %d, %d'
+                             % (other.bits, self.bits))
+        for order, counts in other.orders.items():
+            dict.update(self.orders[order], counts)
+
+    def add_table(self, table):
+        """Add the counts of a CountTable over the same vocabulary.
+        """
+        for order in table.orders():
+            self.add_keys(order, table.keys[order], table.values[order],
+                          table.bits)
+
+    def id_items(self, order=None):
+        """(ids, count) pairs sorted by order and then by ids.
+
+        order -- if given, only the n-grams of this order.
+        """
+        orders = sorted(self.orders) if order is None else [order]
+        for order in orders:
+            counts = self.orders.get(order)
+            if counts:
+                keys = sorted(counts)
+                yield from zip(_unpack_ids(keys, order, self.bits),
+                               map(counts.__getitem__, keys))
+
+    def clear(self):
+        self.orders.clear()
+
+    def __getitem__(self, ids):
+        key = 0
+        for i in ids:
+            key = key << self.bits | i
+        counts = self.orders.get(len(ids))
+        if counts is None or key not in counts:
+            raise KeyError(ids)
+        return counts[key]
+
+    def __iter__(self):
+        for ids, _ in self.id_items():
+            yield ids
+
+    def __len__(self):
+        return sum(len(counts) for counts in self.orders.values())
+
+
+class _SortedIndex(object):
+    """Binary search over the sorted keys of an order, with the get() method
+    of a dict.
+
+    A directory with the first position of the keys of each range of their
+    high bits narrows the search to about BUCKET keys.
+    """
+
+    BUCKET = 16
+
+    def __init__(self, keys, values):
+        """
+        keys -- sorted packed keys of an order, at least one.
+        values -- parallel sequence of values.
+        """
+        self.keys = keys
+        self.values = values
+        last = len(keys) - 1
+        buckets = (len(keys) // self.BUCKET).bit_length()
+        self.shift = max(0, keys[last].bit_length() - buckets)
+        self.size = (keys[last] >> self.shift) + 1
+        # the last position is the highest one searched, so that every
+        # position found can be read
+        self.starts = array('L', map(
+            bisect_left, repeat(keys),
+            map(lshift, range(self.size + 1), repeat(self.shift)),
+            repeat(0), repeat(last)))
+
+    def get(self, key, default=None):
+        bucket = key >> self.shift
+        if not 0 <= bucket < self.size:
+            return default
+        starts = self.starts
+        i = bisect_left(self.keys, key, starts[bucket], starts[bucket + 1])
+        if self.keys[i] == key:
+            return self.values[i]
+        return default
+
+
+class CountTable(object):
+    """Sorted packed keys and values of the n-grams of each order.
+
+    Lookups are binary searches over the sorted keys, so the table is never
+    copied into a hash index. The lookups of many keys (get_keys) run the
+    searches in C loops.
+    """
+
+    BLOCK = 65536  # keys unpacked at a time by id_items
+
+    def __init__(self, vocab, counts=None, typecode='Q'):
+        """
+        vocab -- the Vocabulary the ids refer to. It must not grow while the
+            table is in use.
+        counts -- dict from tuples of ids to counts, or PackedCounts.
+        typecode -- array typecode of the values (default: 'Q', unsigned 64
+            bit integers).
+        """
+        self.vocab = vocab
+        self.typecode = typecode
+        self.bits = id_bits(len(vocab))
+        self.keys = {}
+        self.values = {}
+        self.index = {}
+        self._indexes = None
+
+        if counts and not isinstance(counts, PackedCounts):
+            packed = PackedCounts(len(vocab))
+            for ids, count in counts.items():
+                packed.add(ids, count)
+            counts = packed
+        if counts:
+            for order, order_counts in counts.orders.items():
+                self._set_counts(order, order_counts, counts.bits)
+
+    @classmethod
+    def from_counts(cls, vocab, counts, typecode='Q'):
+        """Table from PackedCounts, that are emptied as the table is built
+        to save memory.
+
+        vocab -- the Vocabulary the ids refer to.
+        counts -- the PackedCounts.
+        typecode -- array typecode of the values.
+        """
+        table = cls(vocab, typecode=typecode)
+        for order in sorted(counts.orders):
+            table._set_counts(order, counts.orders.pop(order), counts.bits)
+        return table
+
+    def _set_counts(self, order, counts, bits):
+        """Replace the entries of an order with a dict from packed keys to
+        values.
+
+        bits -- number of bits of each id in the keys of the dict.
+        """
+        keys = sorted(counts)
+        self.values[order] = array(self.typecode,
+                                   map(counts.__getitem__, keys))
+        keys = _repack(keys, order, bits, self.bits)
+        self.keys[order] = self._key_array(order, keys)
+        self.index.pop(order, None)
+        self._indexes = None
+
+    @classmethod
+    def from_sorted(cls, vocab, items, typecode='Q'):
+        """Table from a stream of (ids, count) pairs.
+
+        vocab -- the Vocabulary the ids refer to.
+        items -- iterable of (ids, count) pairs, sorted by order and then by
+            ids, without repeated ids.
+        typecode -- array typecode of the values.
+        """
+        table = cls(vocab, typecode=typecode)
+        for ids, count in items:
+            order = len(ids)
+            keys = table.keys.get(order)
+            if keys is None:
+                keys = table.keys[order] = table._key_array(order, [])
+                table.values[order] = array(typecode)
+            keys.append(table.pack(ids))
+            table.values[order].append(count)
+        return table
+
+    def set_order(self, order, keys, values, is_sorted=False):
+        """Replace the entries of an order.
+
+        order -- the order.
+        keys -- sequence of packed keys, in any order and without repeats.
+        values -- parallel sequence of values.
+        is_sorted -- whether the keys are already sorted.
+        """
+        if not is_sorted:
+            self._set_counts(order, dict(zip(keys, values)), self.bits)
+            return
+        self.keys[order] = self._key_array(order, keys)
+        self.values[order] = array(self.typecode, values)
+        self.index.pop(order, None)
+        self._indexes = None
+
+    def _key_array(self, order, keys):
+        """Array for packed keys, or a list if they don't fit in 64 bits.
+        """
+        if order * self.bits <= 64:
+            return array('Q', keys)
+        return list(keys)
+
+    def pack(self, ids):
+        """Packed integer key for a tuple of ids.
+        """
+        key = 0
+        bits = self.bits
+        for i in ids:
+            key = key << bits | i
+        return key
+
+    def unpack(self, key, order):
+        """Tuple of ids for a packed key of the given order.
+        """
+        mask = (1 << self.bits) - 1
+        ids = []
+        for _ in range(order):
+            ids.append(key & mask)
+            key >>= self.bits
+        return tuple(reversed(ids))
+
+    def get(self, ids, default=0):
+        """Count for a tuple of ids.
+
+        ids -- the tuple of ids.
+        default -- value returned if the ids are not present.
+        """
+        return self.get_key(self.pack(ids), len(ids), default)
+
+    def get_key(self, key, order, default=0):
+        """Count for a packed key.
+
+        key -- the packed key.
+        order -- the order of the key.
+        default -- value returned if the key is not present.
+        """
+        index = self.index.get(order)
+        if index is None:
+            index = self._build_index(order)
+        return index.get(key, default)
+
+    def get_keys(self, keys, order, default=0):
+        """List of the values of many packed keys of the same order, as
+        get_key().
+        """
+        keys = list(keys)
+        positions, found = self._search(keys, order)
+        if positions is None:
+            return [default] * len(keys)
+        values = map(self.values[order].__getitem__, positions)
+        return list(map(getitem, zip(repeat(default), values), found))
+
+    def _search(self, keys, order):
+        """Positions of the binary searches of a list of packed keys in the
+        keys of an order (None if there are none), and whether each key was
+        found there.
+        """
+        table_keys = self.keys.get(order)
+        if not table_keys:
+            return None, None
+        # as in _SortedIndex.get
+        positions = list(map(bisect_left, repeat(table_keys), keys,
+                             repeat(0), repeat(len(table_keys) - 1)))
+        found = list(map(eq, map(table_keys.__getitem__, positions), keys))
+        return positions, found
+
+    def indexes(self, size):
+        """List of the indexes of the orders 0 to size - 1, for the hot
+        loops that look up keys of several orders: each one has the get()
+        method of a dict.
+
+        size -- number of orders.
+        """
+        indexes = self._indexes
+        if indexes is None or len(indexes) != size:
+            indexes = self._indexes = [self.index.get(order) or
+                                       self._build_index(order)
+                                       for order in range(size)]
+        return indexes
+
+    def build_indexes(self):
+        """Build the index of every order up front, so that lookups only
+        read the table.
+        """
+        for order in self.keys:
+            if order not in self.index:
+                self._build_index(order)
+
+    def _build_index(self, order):
+        """Index of an order: a binary search over its keys. The empty
+        index of an order without keys is not kept.
+        """
+        keys = self.keys.get(order)
+        if not keys:
+            return {}
+        index = self.index[order] = _SortedIndex(keys, self.values[order])
+        return index
+
+    def successors(self, ids):
+        """(id, count) pairs for the ids that follow a prefix.
+
+        ids -- the prefix tuple of ids.
+        """
+        order = len(ids) + 1
+        start, end = self.successor_range(self.pack(ids), len(ids))
+        if start == end:
+            return
+        keys = self.keys[order]
+        mask = (1 << self.bits) - 1
+        values = self.values[order]
+        for i in range(start, end):
+            yield keys[i] & mask, values[i]
+
+    def successor_range(self, key, order):
+        """Range of positions in the keys of the next order of the n-grams
+        that extend a prefix. As the keys are sorted, the successors of a
+        prefix are contiguous, like the children of a node of a trie.
+
+        key -- packed key of the prefix.
+        order -- the order of the prefix.
+
+        Returns the (start, end) pair of positions.
+        """
+        keys = self.keys.get(order + 1)
+        if keys is None:
+            return 0, 0
+        lo = key << self.bits
+        start = bisect_left(keys, lo)
+        return start, bisect_left(keys, lo + (1 << self.bits), start)
+
+    def suffix_counts(self, key, order):
+        """Counts of every suffix of an n-gram, from the n-gram itself to
+        the empty one. The key of each suffix is a mask of the key of the
+        n-gram, so the ids are packed only once.
+
+        key -- packed key of the n-gram.
+        order -- the order of the n-gram.
+        """
+        bits = self.bits
+        return [self.get_key(key & ((1 << bits * k) - 1), k)
+                for k in range(order, -1, -1)]
+
+    def orders(self):
+        """Sorted list of the orders stored in the table.
+        """
+        return sorted(self.keys)
+
+    def id_items(self, order=None):
+        """(ids, count) pairs for all the stored n-grams.
+
+        order -- if given, only the n-grams of this order.
+        """
+        orders = self.orders() if order is None else [order]
+        for order in orders:
+            if order not in self.keys:
+                continue
+            keys = iter(self.keys[order])
+            values = iter(self.values[order])
+            while True:
+                block = list(islice(keys, self.BLOCK))
+                if not block:
+                    break
+                yield from zip(_unpack_ids(block, order, self.bits),
+                               islice(values, len(block)))
+
+    def items(self):
+        """(tokens, count) pairs for all the stored n-grams.
+        """
+        decode = self.vocab.decode
+        for ids, count in self.id_items():
+            yield decode(ids), count
+
+    def __iter__(self):
+        for tokens, _ in self.items():
+            yield tokens
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.values())
+
+    def lookup(self, tokens, default=0):
+        """Count for a tuple of tokens.
+
+        tokens -- the tuple of tokens.
+        default -- value returned if the tokens are not present.
+        """
+        ids = self.vocab.ids
+        bits = self.bits
+        key = 0
+        for token in tokens:
+            i = ids.get(token)
+            if i is None:
+                return default
+            key = key << bits | i
+        index = self.index.get(len(tokens))
+        if index is None:
+            index = self._build_index(len(tokens))
+        return index.get(key, default)
+
+    def __getitem__(self, tokens):
+        return self.lookup(tokens)
+
+    def __contains__(self, tokens):
+        return self[tokens] > 0
+
+    def __add__(self, other):
+        return combine_tables(Vocabulary(self.vocab.tokens), [self, other])
+
+    def __sub__(self, other):
+        return combine_tables(Vocabulary(self.vocab.tokens), [self, other],
+                              [1, -1])
+
+    def __mul__(self, factor):
+        return combine_tables(Vocabulary(self.vocab.tokens), [self],
+                              [factor])
+
+    __rmul__ = __mul__
+
+
+def count_sents(vocab, sents, n, all_orders=False, heldout=False, first=0,
+                runs=None, unk=None):
+    """Count the n-grams of the sentences in a single pass.
+
+    vocab -- Vocabulary where the new tokens are added. It must contain the
+        <s> and </s> tokens.
+    sents -- iterable of sentences, each one being a list of tokens.
+    n -- order of the model.
+    all_orders -- count the k-grams for every k <= n, instead of only the
+        n-grams and (n-1)-grams.
+    heldout -- keep one of every 10 sentences apart as held-out data.
+    first -- index of the first sentence in the whole corpus.
+    runs -- SortedRuns where the counts are spilled when they grow too much.
+    unk -- if given, a token of vocab (usually <unk>) the unknown tokens are
+        counted as, instead of adding them to vocab.
+
+    Returns the PackedCounts (without the spilled ones) and the
+    PackedCounts of the n-grams of the held-out sentences.
+    """
+    sents = _encode_sents(vocab, sents, unk)
+    return _count_ids(sents, n, vocab.ids[SENT_START],
+                      vocab.ids[SENT_END], vocab.__len__, all_orders,
+                      heldout, first, runs)
+
+
+def _encode_sents(vocab, sents, unk=None):
+    """Iterator of the lists of ids of sentences, adding the new tokens to
+    the vocabulary, or mapping them to the id of unk if given."""
+    add = vocab.add
+    get = vocab.ids.get
+    if unk is not None:
+        unk = vocab.ids[unk]
+        for sent in sents:
+            yield list(map(get, sent, repeat(unk)))
+        return
+    for sent in sents:
+        ids = list(map(get, sent))
+        if None in ids:
+            ids = [add(token) for token in sent]
+        yield ids
+
+
+def _count_ids(sents, n, start, end, size, all_orders=False, heldout=False,
+               first=0, runs=None):
+    """Count the n-grams of sentences of ids, see count_sents.
+
+    sents -- iterable of sentences, each one being a list of ids.
+    start, end -- ids of <s> and </s>.
+    size -- function giving the size of the vocabulary of the ids counted
+        so far.
+    """
+    counts = PackedCounts()
+    orders = counts.orders
+    heldout_counts = PackedCounts()
+    padding = [start] * (n-1)
+
+    for i, ids in enumerate(sents, first):
+        sent = padding + ids
+        sent.append(end)
+        if heldout and i % 10 == 1:
+            # held out, but its tokens are part of the vocabulary: only its
+            # n-grams are kept
+            bits = heldout_counts.reserve(size())
+            keys = sent
+            for j in range(2, n+1):
+                keys = list(map(or_, map(lshift, keys, repeat(bits)),
+                                sent[j-1:]))
+            heldout_counts.orders[n].update(keys)
+            continue
+        bits = counts.reserve(size())
+        # keys[k] is the key of the j-gram starting at k
+        keys = sent
+        if all_orders:
+            # the k-grams of every order that end after the padding
+            orders[0][0] += len(sent) - n + 1
+            orders[1].update(keys[n-1:])
+            start_key = start
+            for j in range(2, n+1):
+                keys = list(map(or_, map(lshift, keys, repeat(bits)),
+                                sent[j-1:]))
+                orders[j].update(keys[n-j:])
+                orders[j-1][start_key] += 1
+                start_key = start_key << bits | start
+        else:
+            for j in range(2, n+1):
+                prefixes = keys
+                keys = list(map(or_, map(lshift, keys, repeat(bits)),
+                                sent[j-1:]))
+            orders[n].update(keys)
+            if n > 1:
+                orders[n-1].update(prefixes[:-1])
+            else:
+                orders[0][0] += len(keys)
+        if runs is not None:
+            runs.check(counts)
+
+    return counts, heldout_counts
+
+
+def merge_sorted(streams):
+    """Merge streams of (ids, count) pairs, adding the counts of equal ids.
+
+    streams -- iterables of (ids, count) pairs, each one sorted by order and
+        then by ids, without repeated ids.
+
+    Returns an iterator of (ids, count) pairs sorted the same way, suitable
+    for CountTable.from_sorted.
+    """
+    keyed = [(((len(ids), ids), count) for ids, count in stream)
+             for stream in streams]
+    last, total = None, 0
+    for (_, ids), count in heap_merge(*keyed):
+        if ids == last:
+            total += count
+        else:
+            if last is not None:
+                yield last, total
+            last, total = ids, count
+    if last is not None:
+        yield last, total
+
+
+def _sorted_items(items, size, max_counts=None):
+    """Sort a stream of (ids, count) pairs by order and then by ids, adding
+    the counts of equal ids and spilling them to temporary files if
+    max_counts is given.
+
+    size -- number of distinct ids.
+    """
+    runs = SortedRuns(max_counts) if max_counts else None
+    counts = PackedCounts(size)
+    for ids, count in items:
+        counts.add(ids, count)
+        if runs is not None:
+            runs.check(counts)
+    if runs is None:
+        return counts.id_items()
+    return runs.merge(counts)
+
+
+def _weighted(items, weight):
+    for ids, count in items:
+        yield ids, count * weight
+
+
+def _nonzero(items):
+    for ids, count in items:
+        if count < 0:
+            raise ValueError('Negative count for %s' % (ids,))
+        if count:
+            yield ids, count
+
+
+def combine_tables(vocab, tables, weights=None, max_counts=None,
+                   rename=None):
+    """Weighted sum of count tables, that may have different vocabularies.
+
+    The tables are read as sorted streams and merged in a single pass, so
+    tables mapped from model files are not loaded in memory. Only the
+    entries of a table whose tokens get their ids in a different order in
+    vocab are sorted again.
+
+    vocab -- Vocabulary of the result, where the tokens of the tables are
+        added.
+    tables -- list of CountTables.
+    weights -- list of factors of the tables (default: 1 for every table),
+        negative to subtract.
+    max_counts -- if given, number of entries of a table sorted in memory,
+        the rest are spilled to temporary files.
+    rename -- dict from tokens to the tokens they are counted as, several
+        tokens may be renamed to the same one.
+
+    Returns a CountTable over vocab without the zero counts, that are floats
+    if some weight is not an integer.
+    """
+    if weights is None:
+        weights = [1] * len(tables)
+    integers = all(float(w).is_integer() for w in weights) and \
+        all(table.typecode == 'Q' for table in tables)
+    rename = rename or {}
+    streams = []
+    for table, weight in zip(tables, weights):
+        ids = [vocab.add(rename.get(token, token))
+               for token in table.vocab.tokens]
+        items = table.id_items()
+        if ids != list(range(len(ids))):
+            items = ((tuple([ids[i] for i in k]), c) for k, c in items)
+            if any(a >= b for a, b in zip(ids, ids[1:])):
+                spill = max_counts if table.typecode == 'Q' else None
+                items = _sorted_items(items, len(vocab), spill)
+        streams.append(_weighted(items, int(weight) if integers else weight))
+    typecode = 'Q' if integers else 'd'
+    return CountTable.from_sorted(vocab, _nonzero(merge_sorted(streams)),
+                                  typecode)
+
+
+# queues of the reducers, set when the pool of counting workers starts
+_partition_queues = None
+
+
+def _set_partition_queues(queues):
+    global _partition_queues
+    _partition_queues = queues
+
+
+def _partition(counts, parts):
+    """Split PackedCounts by the sum of the first and last ids of the
+    n-grams modulo the number of parts (the empty n-gram goes to the first
+    part), so that every process puts an n-gram in the same part.
+
+    Returns a list with a dict per part from orders to lists of keys and
+    counts.
+    """
+    result = [{} for _ in range(parts)]
+    mask = (1 << counts.bits) - 1
+    for order, order_counts in counts.orders.items():
+        keys = list(order_counts)
+        values = list(order_counts.values())
+        if not order:
+            result[0][order] = (keys, values)
+            continue
+        first = map(rshift, keys, repeat(counts.bits * (order - 1)))
+        last = map(and_, keys, repeat(mask))
+        which = list(map(mod, map(add, first, last), repeat(parts)))
+        for part, part_counts in enumerate(result):
+            selected = list(map(eq, which, repeat(part)))
+            part_counts[order] = (list(compress(keys, selected)),
+                                  list(compress(values, selected)))
+    return result
+
+
+def _count_shard(args):
+    """Count a shard of sentences in a worker and send each part of the
+    counts to its reducer.
+
+    The shard comes with the ids of its tokens in the merged vocabulary.
+    """
+    sents, ids, size, start, end, n, all_orders, heldout, first = args
+    get = ids.__getitem__
+    sents = (list(map(get, sent)) for sent in sents)
+    counts, heldout_counts = _count_ids(sents, n, start, end, lambda: size,
+                                        all_orders, heldout, first)
+    queues = _partition_queues
+    parts = zip(_partition(counts, len(queues)),
+                _partition(heldout_counts, len(queues)))
+    for queue, (part, heldout_part) in zip(queues, parts):
+        queue.put((size, counts.bits, part, heldout_part))
+
+
+def _reduce_partition(queue, results, max_counts=None, dir=None):
+    """Add up a part of the counts of every shard in a process.
+
+    The counts of the shards are put in queue by the workers, and the
+    parent ends with the final size of the vocabulary and the number of
+    shards. Then the added counts are put in results, with the runs spilled
+    if max_counts is given.
+    """
+    counts = PackedCounts()
+    heldout_counts = PackedCounts()
+    runs = SortedRuns(max_counts, dir, shared=True) if max_counts else None
+    added = 0
+    shards = final_size = None
+    while shards is None or added < shards:
+        size, bits, part, heldout_part = queue.get()
+        if bits is None:
+            shards, final_size = part, size
+            continue
+        for merged, shard_counts in ((counts, part),
+                                     (heldout_counts, heldout_part)):
+            merged.reserve(size)
+            for order, (keys, values) in shard_counts.items():
+                merged.add_keys(order, keys, values, bits)
+        if runs is not None:
+            runs.check(counts)
+        added += 1
+    counts.reserve(final_size)
+    heldout_counts.reserve(final_size)
+    results.put((counts, heldout_counts,
+                 runs.export() if runs is not None else []))
+
+
+def parallel_count_sents(vocab, sents, n, all_orders=False, heldout=False,
+                         jobs=2, shard_size=10000, runs=None, first=0,
+                         unk=None):
+    """Like count_sents, but counting shards of sentences in a process pool.
+
+    The parent only adds the distinct tokens of each shard to vocab, in
+    corpus order, and sends the shard with the ids of its tokens, so the ids
+    and counts are the same as in a serial count. The workers split the
+    counts of each shard in jobs parts by their ids, and every part is
+    added up in its own reducer process. The parts have no n-gram in
+    common, so the parent joins them at the end without adding any count.
+    At most 2 * jobs shards are waiting to be counted.
+
+    jobs -- number of worker processes, and of reducer processes.
+    shard_size -- number of sentences per shard.
+    """
+    start, end = vocab.ids[SENT_START], vocab.ids[SENT_END]
+    if unk is not None:
+        unk = vocab.ids[unk]
+    queues = [Queue() for _ in range(jobs)]
+    results = Queue()
+    max_counts = dir = None
+    if runs is not None:
+        max_counts, dir = max(1, runs.max_counts // jobs), runs.dir
+    reducers = [Process(target=_reduce_partition,
+                        args=(queue, results, max_counts, dir))
+                for queue in queues]
+    for reducer in reducers:
+        reducer.start()
+    pending = deque()
+    shards = 0
+
+    try:
+        with Pool(jobs, _set_partition_queues, (queues,)) as pool:
+            while True:
+                shard = list(islice(sents, shard_size))
+                if not shard:
+                    break
+                tokens = list(dict.fromkeys(chain.from_iterable(shard)))
+                if unk is None:
+                    new = list(map(is_, map(vocab.ids.get, tokens),
+                                   repeat(None)))
+                    for token in compress(tokens, new):
+                        vocab.add(token)
+                ids = dict(zip(tokens, map(vocab.ids.get, tokens,
+                                           repeat(unk))))
+                args = (shard, ids, len(vocab), start, end, n, all_orders,
+                        heldout, first)
+                pending.append(pool.apply_async(_count_shard, (args,)))
+                shards += 1
+                first += len(shard)
+                if len(pending) >= 2 * jobs:
+                    pending.popleft().get()
+            while pending:
+                pending.popleft().get()
+            # the workers exit once their counts are flushed to the queues
+            pool.close()
+            pool.join()
+        for queue in queues:
+            queue.put((len(vocab), None, shards, None))
+        parts = []
+        while len(parts) < len(reducers):
+            try:
+                parts.append(results.get(timeout=1))
+            except Empty:
+                if any(reducer.exitcode for reducer in reducers):
+                    raise RuntimeError('A reducer process failed')
+    except BaseException:
+        for reducer in reducers:
+            reducer.terminate()
+        raise
+    for reducer in reducers:
+        reducer.join()
+
+    counts = PackedCounts(len(vocab))
+    heldout_counts = PackedCounts(len(vocab))
+    for part, heldout_part, part_runs in parts:
+        counts.add_disjoint(part)
+        heldout_counts.add_disjoint(heldout_part)
+        if runs is not None:
+            runs.adopt(part_runs)
+    return counts, heldout_counts
+
+
+class SortedRuns(object):
+    """Counts spilled to temporary files as runs sorted by order and ids.
+
+    Each run is a file with a section per order, made of fixed-width records
+    (the ids followed by the count) in an array of unsigned 64 bit integers.
+    """
+
+    BLOCK = 4096  # records read at a time
+
+    def __init__(self, max_counts, dir=None, shared=False):
+        """
+        max_counts -- number of distinct n-grams kept in memory before
+            spilling them.
+        dir -- directory for the temporary files (default: the system's).
+        shared -- write the runs to named files, so that they can be passed
+            to another process (see export).
+        """
+        self.max_counts = max_counts
+        self.dir = dir
+        self.shared = shared
+        self.runs = []  # (file, {order: (offset, size)})
+
+    def check(self, counts):
+        """Spill the counts if there are too many of them.
+        """
+        if len(counts) >= self.max_counts:
+            self.spill(counts)
+
+    def spill(self, counts):
+        """Write the PackedCounts as a new sorted run and clear them.
+        """
+        if self.shared:
+            f = NamedTemporaryFile(dir=self.dir, delete=False)
+        else:
+            f = TemporaryFile(dir=self.dir)
+        index = {}
+        for order in sorted(counts.orders):
+            size = len(counts.orders[order])
+            if not size:
+                continue
+            index[order] = (f.tell(), size)
+            items = counts.id_items(order)
+            for _ in range(0, size, self.BLOCK):
+                records = array('Q')
+                for ids, count in islice(items, self.BLOCK):
+                    records.extend(ids)
+                    records.append(count)
+                records.tofile(f)
+        self.runs.append((f, index))
+        counts.clear()
+
+    def export(self):
+        """Close the runs of a shared SortedRuns and return them as a list
+        of (file name, index) pairs, for adopt.
+        """
+        exported = [(f.name, index) for f, index in self.runs]
+        for f, _ in self.runs:
+            f.close()
+        self.runs = []
+        return exported
+
+    def adopt(self, exported):
+        """Take the runs exported by another SortedRuns. Their files are
+        removed once opened, like the temporary ones.
+        """
+        for name, index in exported:
+            f = open(name, 'rb')
+            os.unlink(name)
+            self.runs.append((f, index))
+
+    def _read(self, f, offset, size, order):
+        """(ids, count) pairs of a section of a run."""
+        width = order + 1
+        f.seek(offset)
+        while size:
+            block = min(size, self.BLOCK)
+            records = array('Q')
+            records.fromfile(f, block * width)
+            for j in range(0, block * width, width):
+                yield tuple(records[j: j + order]), records[j + order]
+            size -= block
+
+    def merge(self, counts):
+        """Merge the spilled runs and the PackedCounts still in memory.
+
+        Returns an iterator of (ids, count) pairs sorted by order and then by
+        ids, suitable for CountTable.from_sorted. The runs are consumed.
+        """
+        orders = set(counts.orders)
+        for _, index in self.runs:
+            orders.update(index)
+        for order in sorted(orders):
+            in_memory = counts.id_items(order)
+            streams = [in_memory] + [
+                self._read(f, index[order][0], index[order][1], order)
+                for f, index in self.runs if order in index]
+            yield from merge_sorted(streams)
+        for f, _ in self.runs:
+            f.close()
+        self.runs = []
@@ -1,48 +1,458 @@
-from collections import defaultdict
-from math import log
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, namedtuple, deque
+from collections.abc import Mapping
+from functools import lru_cache
+from heapq import nlargest
+from itertools import accumulate, chain, compress, islice, repeat
+from math import log, exp, fsum, sqrt
+from multiprocessing import get_context
+from operator import and_, itemgetter, lshift, mul, neg, or_, rshift, sub
 
 import random
 
-SENT_START = '<s>'
-SENT_END = '</s>'
+from languagemodeling.counts import SENT_START, SENT_END, Vocabulary, \
+    CountTable, SortedRuns, count_sents, parallel_count_sents, \
+    merge_sorted, combine_tables
+from languagemodeling.storage import save_model, load_model
+from languagemodeling.arpa import UNK, read_arpa
+
+GOLDEN = (sqrt(5) - 1) / 2
+
+Scores = namedtuple('Scores', ['token_log_probs', 'sent_log_probs',
+                               'log_prob', 'cross_entropy', 'perplexity'])
+
+
+def _minimize(f, candidates, log_scale=False, iterations=30, tol=0.01):
+    """Minimize a function of one parameter.
+
+    The candidates are tried first, and then a golden-section search runs
+    between the neighbours of the best one, until the bracket shrinks below
+    tol times its initial width. The result is never worse than the best
+    candidate.
+
+    f -- the function.
+    candidates -- sorted list of values to try.
+    log_scale -- whether to search over the logarithm of the parameter.
+    iterations -- maximum number of golden-section steps.
+    tol -- relative width of the bracket that stops the search (default:
+        0.01, about 10 steps).
+    """
+    values = [f(x) for x in candidates]
+    i = min(range(len(candidates)), key=values.__getitem__)
+    best = [candidates[i], values[i]]
+    if values[i] == float('inf'):
+        return best[0]
+
+    def g(t):
+        x = exp(t) if log_scale else t
+        y = f(x)
+        if y < best[1]:
+            best[:] = [x, y]
+        return y
+
+    a = candidates[max(i - 1, 0)]
+    b = candidates[min(i + 1, len(candidates) - 1)]
+    if log_scale:
+        a, b = log(a), log(b)
+    width = tol * (b - a)
+    c, d = b - GOLDEN * (b - a), a + GOLDEN * (b - a)
+    gc, gd = g(c), g(d)
+    for _ in range(iterations):
+        if b - a <= width:
+            break
+        if gc < gd:
+            b, d, gd = d, c, gc
+            c = b - GOLDEN * (b - a)
+            gc = g(c)
+        else:
+            a, c, gc = c, d, gd
+            d = a + GOLDEN * (b - a)
+            gd = g(d)
+    return best[0]
+
+
+# model used by the scoring workers, inherited when they are forked
+_shared_model = None
+
+
+def _set_shared_model(model):
+    global _shared_model
+    _shared_model = model
+
+
+def _score_shard(args):
+    sents, base = args
+    scores = _shared_model.score_sents(sents, base)
+    return scores.token_log_probs, scores.sent_log_probs
+
+
+# generator used by the generation workers, inherited when they are forked
+_shared_generator = None
+
+
+def _set_shared_generator(generator):
+    global _shared_generator
+    _shared_generator = generator
+
+
+def _generate_batch(args):
+    seed, size = args
+    return _shared_generator.generate_batch(seed, size)
 
 
 class NGram(object):
 
-    def __init__(self, n, sents):
+    # attributes saved by save(), besides the vocabulary
+    PARAMS = ('n', 'vocab_size', 'train_size', 'heldout')
+    TABLES = ('counts',)
+    # tables of counts, added when merging models
+    COUNT_TABLES = ('counts',)
+    # whether the k-grams of every order k <= n are counted
+    ALL_ORDERS = False
+    # distinct n-grams whose score is remembered by score_sents
+    SCORE_CACHE_SIZE = 2 ** 20
+    # sentences whose distinct n-grams are scored at a time by score_sents
+    SCORE_CHUNK_SIZE = 1000
+    # attributes besides the tables that the probabilities depend on,
+    # setting one empties the caches
+    SCORING_PARAMS = ('n', 'vocab', 'vocab_size')
+    # whether the model is read-only, see freeze()
+    frozen = False
+    # methods memoized by enable_cache()
+    CACHED = ('_key_prob',)
+
+    def __init__(self, n, sents, jobs=1, max_counts=None):
         """
         n -- order of the model.
-        sents -- list of sentences, each one being a list of tokens.
+        sents -- iterable of sentences, each one being a list of tokens. It is
+            consumed in a single pass, so it may be a generator.
+        jobs -- number of processes used for counting (default: 1).
+        max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
         """
         assert n > 0
         self.n = n
-        self.counts = defaultdict(int)
+        self._train(sents, jobs=jobs, max_counts=max_counts)
+
+    def _train(self, sents, all_orders=False, heldout=False, jobs=1,
+               max_counts=None):
+        """Count the n-grams of the sentences in a single pass.
+
+        sents -- iterable of sentences, each one being a list of tokens.
+        all_orders -- count the k-grams for every k <= n, instead of only the
+            n-grams and (n-1)-grams.
+        heldout -- keep one of every 10 sentences apart as held-out data.
+        jobs -- number of processes used for counting.
+        max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
+
+        Returns the PackedCounts of the held-out n-grams.
+        """
+        self.vocab = Vocabulary([SENT_START, SENT_END])
+        self.counts = None
+        self.train_size = 0
+        self.heldout = heldout
+        return self._add_sents(sents, all_orders, jobs, max_counts)
+
+    def _add_sents(self, sents, all_orders, jobs, max_counts):
+        """Add the counts of the sentences to the model, holding out data as
+        in training (see _train).
+
+        The counts of the table are added to the new ones, or merged with
+        them as sorted streams if they were spilled to disk.
+        """
+        # counting adds the new tokens to the vocabulary in place
+        self._check_not_frozen()
+        first = self.train_size
+        added = 0
+
+        def numbered(sents):
+            nonlocal added
+            for sent in sents:
+                added += 1
+                yield sent
+
+        runs = SortedRuns(max_counts) if max_counts else None
+        # with a restricted vocabulary, the new tokens are counted as <unk>
+        unk = UNK if UNK in self.vocab else None
+        if jobs > 1:
+            counts, heldout_counts = parallel_count_sents(
+                self.vocab, numbered(sents), self.n, all_orders,
+                self.heldout, jobs, runs=runs, first=first, unk=unk)
+        else:
+            counts, heldout_counts = count_sents(
+                self.vocab, numbered(sents), self.n, all_orders,
+                self.heldout, first, runs=runs, unk=unk)
+
+        if runs is None:
+            if self.counts is not None:
+                counts.add_table(self.counts)
+            self.counts = CountTable.from_counts(self.vocab, counts)
+        else:
+            items = runs.merge(counts)
+            if self.counts is not None:
+                items = merge_sorted([self.counts.id_items(), items])
+            self.counts = CountTable.from_sorted(self.vocab, items)
+        self.train_size = first + added
+        self.vocab_size = len(self.vocab) - 1  # every token but <s>
+        return heldout_counts
+
+    def update(self, sents, jobs=1, max_counts=None):
+        """Add sentences to the training data, with the same result as
+        training again on the whole corpus.
+
+        If the vocabulary was restricted, the new tokens are counted as
+        <unk> (see restrict_vocab).
+
+        sents -- iterable of sentences, each one being a list of tokens.
+        jobs -- number of processes used for counting (default: 1).
+        max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
+        """
+        self._add_sents(sents, self.ALL_ORDERS, jobs, max_counts)
+
+    @staticmethod
+    def merge(models, weights=None, max_counts=None):
+        """Combine models of the same class and order trained on different
+        corpora, as if trained on all of them.
+
+        The counts are added, or weighted, in a single pass over the sorted
+        tables, and the tables derived from them are built again. The other
+        parameters, such as gamma or beta, are those of the first model.
+
+        models -- list of models.
+        weights -- list of factors of the counts of each model (default: 1
+            for every model), negative to subtract.
+        max_counts -- if given, number of entries of a table sorted again in
+            memory, the rest are spilled to temporary files.
+        """
+        first = models[0]
+        cls = type(first)
+        assert all(type(m) is cls and m.n == first.n for m in models)
+        if not cls.COUNT_TABLES:
+            raise ValueError('%s models have no counts to merge' %
+                             cls.__name__)
+
+        model = cls.__new__(cls)
+        for name in cls.PARAMS:
+            setattr(model, name, getattr(first, name))
+        model.vocab = Vocabulary(first.vocab.tokens)
+        for name in cls.COUNT_TABLES:
+            tables = [getattr(m, name) for m in models]
+            if all(table is None for table in tables):
+                continue
+            tables = [CountTable(m.vocab) if table is None else table
+                      for m, table in zip(models, tables)]
+            setattr(model, name, combine_tables(model.vocab, tables, weights,
+                                                max_counts))
+        model.vocab_size = len(model.vocab) - 1  # every token but <s>
+        model.train_size = sum(m.train_size for m in models)
+        model._counts_changed()
+        return model
+
+    def _counts_changed(self):
+        """Build again the tables derived from the counts.
+        """
+
+    def restrict_vocab(self, max_vocab=None, min_count=None,
+                       max_counts=None):
+        """Keep only the most frequent tokens, counting the rest as <unk>.
+
+        The counts are those of training on the corpus with the rare tokens
+        replaced by <unk>. Unknown tokens are then scored as <unk>, and
+        counted as <unk> by update().
+
+        max_vocab -- if given, number of tokens kept, besides <s>, </s> and
+            <unk>.
+        min_count -- if given, tokens seen less times are counted as <unk>.
+        max_counts -- if given, number of entries sorted again in memory,
+            the rest are spilled to temporary files.
+        """
+        # every token is the last one of exactly one counted n-gram
+        freqs = defaultdict(int)
+        for ids, count in self.counts.id_items(self.n):
+            freqs[ids[-1]] += count
+        special = {SENT_START, SENT_END, UNK}
+        tokens = [t for t in self.vocab.tokens if t not in special]
+        ids = self.vocab.ids
+        tokens.sort(key=lambda t: (-freqs[ids[t]], ids[t]))
+        if min_count:
+            tokens = [t for t in tokens if freqs[ids[t]] >= min_count]
+        kept = special.union(tokens[:max_vocab])
+        rename = {t: UNK for t in self.vocab.tokens if t not in kept}
+        if not rename:
+            return
+
+        vocab = Vocabulary([SENT_START, SENT_END])
+        for name in self.COUNT_TABLES:
+            table = getattr(self, name)
+            if table is not None:
+                setattr(self, name, combine_tables(vocab, [table],
+                                                   max_counts=max_counts,
+                                                   rename=rename))
+        self.vocab = vocab
+        self.vocab_size = len(vocab) - 1  # every token but <s>
+        self._counts_changed()
+
+    def freeze(self):
+        """Make the model read-only, to share it between threads.
+
+        Queries only read the count tables, so a model can serve many
+        threads without locks as long as it doesn't change. Once frozen,
+        setting an attribute raises AttributeError: updating, restricting
+        the vocabulary, pruning, tuning or changing a hyper-parameter.
+
+        The indexes of the tables and the bound _key_probs function are
+        built here, so queries on the frozen model mutate nothing.
+        """
+        for name in self.TABLES:
+            table = getattr(self, name)
+            if table is not None:
+                table.build_indexes()
+        self._bound_key_probs()
+        self.frozen = True
+
+    def _check_not_frozen(self):
+        if self.frozen:
+            raise AttributeError('The model is frozen')
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError('The model is frozen')
+        super().__setattr__(name, value)
+        if name in self.TABLES or name in self.SCORING_PARAMS:
+            self._invalidate()
+
+    def _invalidate(self):
+        """Drop what was computed from the tables and hyper-parameters: the
+        bound _key_probs function and the cached probabilities. It is called
+        when one of them is set.
+        """
+        self.__dict__.pop('_key_probs_function', None)
+        self.clear_cache()
+
+    def __getstate__(self):
+        # the caches are not pickled
+        return {name: value for name, value in self.__dict__.items()
+                if name not in self.CACHED and
+                name != '_key_probs_function'}
+
+    def enable_cache(self, maxsize=2 ** 16):
+        """Remember the conditional probabilities of the last maxsize
+        distinct (context, token) pairs.
+
+        The caches are emptied whenever a table or a hyper-parameter of the
+        model is set, as when a hyper-parameter is changed or tuned, or the
+        counts updated. They can be enabled on a frozen model. They help
+        sent_log_prob() and score() on text that repeats its n-grams;
+        score_sents() already scores each distinct n-gram of a batch once.
+
+        maxsize -- number of entries of each cache (None for no limit).
+        """
+        for name in self.CACHED:
+            method = getattr(type(self), name).__get__(self)
+            super().__setattr__(name, lru_cache(maxsize=maxsize)(method))
 
-        for sent in sents:
-            sent = [SENT_START] * (n-1) + sent + [SENT_END]
-            for i in range(len(sent) - n + 1):
-                ngram = tuple(sent[i: i + n])
-                self.counts[ngram] += 1
-                self.counts[ngram[:-1]] += 1
+    def disable_cache(self):
+        """Stop memoizing and free the caches.
+        """
+        for name in self.CACHED:
+            self.__dict__.pop(name, None)
 
-        self.set_vocab_size(sents)
+    def clear_cache(self):
+        """Empty the caches, if enabled.
+        """
+        for name in self.CACHED:
+            cached = self.__dict__.get(name)
+            if cached is not None:
+                cached.cache_clear()
+
+    def cache_info(self):
+        """Dict from the names of the memoized methods to the statistics of
+        their caches (hits, misses, maxsize, currsize), empty if the caches
+        are not enabled.
+        """
+        return {name: self.__dict__[name].cache_info()
+                for name in self.CACHED if name in self.__dict__}
+
+    def _tune(self, name, candidates, heldout_counts, log_scale=False):
+        """Set a hyper-parameter minimizing the held-out perplexity.
+
+        The statistics of every distinct held-out n-gram that don't depend
+        on the hyper-parameter are collected once, from its packed key, with
+        _event_stats, so each value tried only takes arithmetic, in
+        _stats_prob.
+
+        name -- name of the hyper-parameter attribute.
+        candidates -- sorted list of values to try before refining.
+        heldout_counts -- PackedCounts of the held-out n-grams, whose tokens
+            are all in the vocabulary.
+        log_scale -- whether to search over the logarithm of the parameter.
+        """
+        n = self.n
+        # the held-out ids are packed as the keys of the model
+        bits = heldout_counts.reserve(len(self.vocab))
+        events = heldout_counts.orders.get(n, {})
+        multiplicities = list(events.values())
+        total = sum(multiplicities)
+        stats = list(map(self._event_stats,
+                         map(rshift, events, repeat(bits)), repeat(n - 1),
+                         map(and_, events, repeat((1 << bits) - 1))))
+
+        def perplexity(value):
+            setattr(self, name, value)
+            if not total:
+                return float('inf')
+            probs = list(map(self._stats_prob, stats))
+            if min(probs) <= 0.:
+                return float('inf')
+            logp = sum(map(mul, multiplicities, map(log, probs, repeat(2))))
+            return 2. ** (-logp / total)
+
+        setattr(self, name, _minimize(perplexity, candidates, log_scale))
+
+    def save(self, filename):
+        """Save the model in the binary format of languagemodeling.storage.
+
+        filename -- name of the file.
+        """
+        params = {name: getattr(self, name) for name in self.PARAMS}
+        tables = {name: getattr(self, name) for name in self.TABLES
+                  if getattr(self, name) is not None}
+        save_model(filename, type(self).__name__, params, self.vocab, tables)
 
-    def set_vocab_size(self, sents):
-        vocab = set()
-        for sent in sents:
-            for token in sent:
-                vocab.add(token)
-        self.vocab_size = len(vocab) + 1  # Count </s>
+    @staticmethod
+    def load(filename):
+        """Load a model saved with save(), mapping the file in memory.
+
+        filename -- name of the file.
+        """
+        class_name, params, vocab, tables = load_model(filename)
+        classes = [NGram]
+        while classes:
+            cls = classes.pop()
+            if cls.__name__ == class_name:
+                break
+            classes.extend(cls.__subclasses__())
+        else:
+            raise ValueError('Unknown model class: %s' % class_name)
+
+        model = cls.__new__(cls)
+        model.vocab = vocab
+        for name, value in params.items():
+            setattr(model, name, value)
+        for name, table in tables.items():
+            setattr(model, name, table)
+        return model
 
     def count(self, tokens):
-        """Count for an n-gram or (n-1)-gram.
+        """Count for an n-gram or (n-1)-gram, 0 if unseen. The count table is
+        only read, never modified.
 
         tokens -- the n-gram or (n-1)-gram tuple.
         """
-        result = self.counts[tokens]
-        if not result:
-            del self.counts[tokens]
-        return result
+        return self.counts.lookup(tokens)
 
     def cond_prob(self, token, prev_tokens=None):
         """Conditional probability of a token.
@@ -51,25 +461,205 @@ class NGram(object):
         prev_tokens -- the previous n-1 tokens (optional only if n = 1).
         """
         prev_tokens = prev_tokens or ()
-        prev_tokens = tuple(prev_tokens)
         assert len(prev_tokens) == self.n - 1
-        tokens = prev_tokens + (token,)
-        return float(self.count(tokens)) / self.count(prev_tokens)
+        key, known = self._context_key(prev_tokens)
+        return self._key_prob(key, known, self.vocab.ids.get(token, -1))
+
+    def map_unknown(self, sent):
+        """Sentence with the unknown tokens replaced by <unk>, if the model
+        has it (see restrict_vocab).
+
+        sent -- the sentence as a list of tokens.
+        """
+        ids = self.vocab.ids
+        if UNK not in ids:
+            return list(sent)
+        return [token if token in ids else UNK for token in sent]
+
+    def begin_sentence(self):
+        """State of the scoring at the beginning of a sentence, see score().
+
+        A state is an integer with the packed key of the previous n-1 tokens
+        and, above it, how many of the last ones are in the vocabulary, so
+        that the counts of every suffix of the context are found by masking
+        the key instead of building tuples.
+        """
+        table = self._key_table()
+        width = table.bits * (self.n - 1)
+        start = self.vocab.ids[SENT_START]
+        return (self.n - 1) << width | table.pack((start,) * (self.n - 1))
+
+    def score(self, state, token, base=2.):
+        """Log-probability of a token after a state, and the state after it.
+
+        Unknown tokens are scored as <unk> if the model has it.
+
+        state -- a state returned by begin_sentence() or score().
+        token -- the token.
+        base -- base of the logarithm.
+        """
+        prob, state = self._advance(state, token)
+        return log(prob, base) if prob > 0. else float('-inf'), state
+
+    def _advance(self, state, token):
+        """Probability of a token after a state, and the state after it.
+        """
+        n = self.n
+        bits = self._key_table().bits
+        width = bits * (n - 1)
+        key = state & ((1 << width) - 1)
+        known = state >> width
+        ids = self.vocab.ids
+        i = ids.get(token)
+        if i is None:
+            i = ids.get(UNK, -1)
+        prob = self._key_prob(key, known, i)
+        if i < 0:
+            # no n-gram with an unknown token is counted, any id does in the
+            # key
+            i = known = 0
+        elif known < n - 1:
+            known += 1
+        return prob, known << width | ((key << bits | i) & ((1 << width) - 1))
+
+    def _key_probs(self, keys, knowns, ids):
+        """List of the values of _key_prob() for many events, given by the
+        parallel sequences of its arguments.
+        """
+        if '_key_prob' in self.__dict__:
+            # memoized, see enable_cache()
+            return list(map(self._key_prob, keys, knowns, ids))
+        return self._bound_key_probs()(keys, knowns, ids)
+
+    def _bound_key_probs(self):
+        """Function computing _key_probs(), built by _bind_key_probs() once
+        and dropped whenever a table or hyper-parameter is set.
+        """
+        key_probs = self.__dict__.get('_key_probs_function')
+        if key_probs is None:
+            key_probs = self._bind_key_probs()
+            self.__dict__['_key_probs_function'] = key_probs
+        return key_probs
+
+    def _bind_key_probs(self):
+        """Function of (keys, knowns, ids) computing _key_probs() in a
+        single loop, with the indexes of the tables bound to it.
+        """
+        n = self.n
+        bits = self.counts.bits
+        counts = self.counts.indexes(n + 1)
+        contexts, ngrams = counts[n - 1], counts[n]
+
+        def key_probs(keys, knowns, ids):
+            probs = []
+            for key, known, i in zip(keys, knowns, ids):
+                count = contexts.get(key, 0) if known >= n - 1 else 0
+                # unseen contexts have probability 0
+                probs.append(float(ngrams.get(key << bits | i, 0)) / count
+                             if count else 0.)
+            return probs
+
+        return key_probs
+
+    def _key_table(self):
+        """Table whose packing is used for the keys of the states.
+        """
+        return self.counts
+
+    def _context_key(self, prev_tokens):
+        """Packed key of a context and how many of its last tokens are in
+        the vocabulary, as in a state.
+
+        prev_tokens -- the context tuple.
+        """
+        bits = self._key_table().bits
+        ids = self.vocab.ids
+        key = known = 0
+        for token in prev_tokens:
+            i = ids.get(token)
+            if i is None:
+                i = known = 0
+            else:
+                known += 1
+            key = key << bits | i
+        return key, known
+
+    def _key_prob(self, key, known, i):
+        """Conditional probability of a token after a context given by its
+        packed key, as cond_prob().
+
+        key -- packed key of the previous n-1 tokens.
+        known -- how many of the last previous tokens are in the vocabulary.
+        i -- id of the token, -1 if unknown.
+        """
+        n = self.n
+        counts = self.counts
+        if known < n - 1:
+            return 0.
+        count = counts.get_key(key, n - 1)
+        if not count:
+            # unseen context
+            return 0.
+        return float(counts.get_key(key << counts.bits | i, n)) / count
+
+    def _sent_keys(self, sent):
+        """Arguments of _key_prob() for the tokens of a sentence and </s>:
+        the lists of the packed keys of the contexts, of how many of their
+        last tokens are known, and of the ids of the tokens. Unknown tokens
+        are scored as <unk> if the model has it.
+
+        The state is advanced as _advance() does, within a single frame.
+        """
+        n = self.n
+        bits = self._key_table().bits
+        ids = self.vocab.ids
+        token_ids = list(map(ids.get, sent + [SENT_END],
+                             repeat(ids.get(UNK, -1))))
+        size = len(token_ids)
+        if -1 not in token_ids:
+            # every context is known: the keys are packed by C loops over
+            # the ids, as in counting
+            padded = [ids[SENT_START]] * (n - 1) + token_ids
+            keys = padded[:size] if n > 1 else [0] * size
+            for j in range(1, n - 1):
+                keys = map(or_, map(lshift, keys, repeat(bits)),
+                           padded[j:j + size])
+            return list(keys), [n - 1] * size, token_ids
+
+        mask = (1 << bits * (n - 1)) - 1
+        keys = []
+        knowns = []
+        key = self.begin_sentence() & mask
+        known = n - 1
+
+        for i in token_ids:
+            keys.append(key)
+            knowns.append(known)
+            if i < 0:
+                i = known = 0
+            elif known < n - 1:
+                known += 1
+            key = (key << bits | i) & mask
+
+        return keys, knowns, token_ids
+
+    def _sent_probs(self, sent):
+        """Conditional probabilities of the tokens of a sentence and of
+        </s>.
+        """
+        return self._key_probs(*self._sent_keys(sent))
 
     def sent_prob(self, sent):
         """Probability of a sentence. Warning: subject to underflow problems.
 
         sent -- the sentence as a list of tokens.
         """
-        sent = sent + [SENT_END]
         result = 1.
-        prev_tokens = (SENT_START,) * (self.n-1)
 
-        for token in sent:
-            result *= self.cond_prob(token, prev_tokens)
+        for prob in self._sent_probs(sent):
+            result *= prob
             if result < 1e-12:
                 return 0.
-            prev_tokens = (prev_tokens + (token,))[1:]
 
         return result
 
@@ -78,40 +668,156 @@ class NGram(object):
 
         sent -- the sentence as a list of tokens.
         """
-        sent = sent + [SENT_END]
         result = 0.
-        prev_tokens = (SENT_START,) * (self.n - 1)
 
-        try:
-            for token in sent:
-                result += log(self.cond_prob(token, prev_tokens), base)
-                prev_tokens = (prev_tokens + (token,))[1:]
-        except ValueError:  # log(0)
-            return float("-inf")
+        for prob in self._sent_probs(sent):
+            if prob <= 0.:
+                return float('-inf')
+            result += log(prob, base)
 
         return result
 
+    def score_sents(self, sents, base=2.):
+        """Score a batch of sentences.
+
+        The sentences are mapped to the packed keys of their events, as
+        sent_log_prob() does, all the unknown tokens to the same id as the
+        models treat them alike (<unk> if the model has it), and the
+        conditional probability of each distinct event is computed only
+        once. The new events of every SCORE_CHUNK_SIZE sentences are scored
+        together by _key_probs().
+
+        sents -- iterable of sentences, consumed in a single pass.
+        base -- base of the logarithms.
+
+        Returns a Scores tuple with the log-probabilities of the tokens of
+        each sentence (</s> included), the log-probability of each sentence,
+        and the total log-probability, cross entropy and perplexity.
+        """
+        sents = iter(sents)
+        inf = float('-inf')
+        cache = {}
+        token_log_probs = []
+        sent_log_probs = []
+        size = 0
+
+        while True:
+            chunk = [list(zip(*self._sent_keys(sent)))
+                     for sent in islice(sents, self.SCORE_CHUNK_SIZE)]
+            if not chunk:
+                break
+            if len(cache) >= self.SCORE_CACHE_SIZE:
+                cache.clear()
+            new = [event for event in dict.fromkeys(chain.from_iterable(chunk))
+                   if event not in cache]
+            if new:
+                probs = self._key_probs(*zip(*new))
+                cache.update(zip(new, [log(prob, base) if prob > 0. else inf
+                                       for prob in probs]))
+            for events in chunk:
+                log_probs = list(map(cache.__getitem__, events))
+                token_log_probs.append(log_probs)
+                sent_log_probs.append(sum(log_probs))
+                size += len(log_probs)
+
+        logp = sum(sent_log_probs)
+        crosse = -logp / size if size else float('nan')
+        return Scores(token_log_probs, sent_log_probs, logp, crosse,
+                      base ** crosse)
+
+    def parallel_score_sents(self, sents, jobs=2, base=2., shard_size=1000):
+        """Like score_sents, but scoring shards of sentences in a pool of
+        forked processes, that inherit the model instead of receiving it
+        pickled. At most 2 * jobs shards are held in memory.
+
+        sents -- iterable of sentences, consumed in a single pass.
+        jobs -- number of worker processes.
+        base -- base of the logarithms.
+        shard_size -- number of sentences per shard.
+        """
+        sents = iter(sents)
+        token_log_probs = []
+        sent_log_probs = []
+        pending = deque()
+
+        def merge(result):
+            shard_token_log_probs, shard_sent_log_probs = result.get()
+            token_log_probs.extend(shard_token_log_probs)
+            sent_log_probs.extend(shard_sent_log_probs)
+
+        with get_context('fork').Pool(jobs, _set_shared_model,
+                                      (self,)) as pool:
+            while True:
+                shard = list(islice(sents, shard_size))
+                if not shard:
+                    break
+                pending.append(pool.apply_async(_score_shard,
+                                                ((shard, base),)))
+                if len(pending) >= 2 * jobs:
+                    merge(pending.popleft())
+            while pending:
+                merge(pending.popleft())
+
+        logp = sum(sent_log_probs)
+        size = sum(len(log_probs) for log_probs in token_log_probs)
+        crosse = -logp / size if size else float('nan')
+        return Scores(token_log_probs, sent_log_probs, logp, crosse,
+                      base ** crosse)
+
     def log_probability(self, sents, base=2.):
         """Total log probability of a test set
         """
-        return sum(self.sent_log_prob(sent, base) for sent in sents)
+        return self.score_sents(sents, base).log_prob
 
     def cross_entropy(self, sents, base=2.):
         """Cross entropy of a test set
         """
-        return -self.log_probability(sents, base) \
-            / sum(len(sent) + 1 for sent in sents)
+        return self.score_sents(sents, base).cross_entropy
 
     def perplexity(self, sents, base=2.):
         """Perplexity of a test set
         """
-        return base ** self.cross_entropy(sents, base)
+        return self.score_sents(sents, base).perplexity
 
     def logp_entropy_perplexity(self, sents, base=2.):
-        logp = self.log_probability(sents, base)
-        crosse = -logp / sum(len(sent) + 1 for sent in sents)
-        perp = base ** crosse
-        return logp, crosse, perp
+        scores = self.score_sents(sents, base)
+        return scores.log_prob, scores.cross_entropy, scores.perplexity
+
+    def sample_id(self, prev_ids, generator):
+        """Id of a token sampled from the distribution after a context.
+
+        prev_ids -- tuple of ids of the previous n-1 tokens.
+        generator -- the NGramGenerator, that draws from the counts.
+        """
+        return generator.draw(prev_ids)
+
+    def sample_unseen_id(self, prev_ids, generator):
+        """Id of a token sampled from the distribution after a context,
+        among the tokens not seen after it at full order (None if they have
+        no probability).
+
+        prev_ids -- tuple of ids of the previous n-1 tokens.
+        generator -- the NGramGenerator, that draws from the counts.
+        """
+        return None
+
+    def _sample_addone(self, prev_ids, generator):
+        """Sample from (c(x1..xkx) + 1) / (c(x1..xk) + V): the counts with
+        probability c(x1..xk) / (c(x1..xk) + V), else uniformly.
+        """
+        count = self.counts.get(prev_ids)
+        if generator.rng.random() * (count + self.V()) < count:
+            return generator.draw(prev_ids)
+        return generator.uniform()
+
+    def _sample_unseen_addone(self, prev_ids, generator):
+        """Sample from the add-one estimate without the seen tokens, where
+        only the uniform part is left.
+        """
+        while True:
+            i = generator.uniform()
+            if not self.counts.get(prev_ids + (i,)):
+                return i
 
     def V(self):
         """Size of the vocabulary.
@@ -119,26 +825,320 @@ class NGram(object):
         return self.vocab_size
 
 
-class NGramGenerator(object):
+class _ContextProbs(Mapping):
+    """Read-only mapping from the contexts of a generator to the tokens
+    seen after them and their probabilities.
+    """
 
-    def __init__(self, model):
+    def __init__(self, generator, factory):
+        """
+        generator -- the NGramGenerator.
+        factory -- list or dict, the type of the values.
+        """
+        self.generator = generator
+        self.factory = factory
+
+    def __getitem__(self, prev_tokens):
+        tokens, probs, _ = self.generator.context_table(tuple(prev_tokens))
+        if not tokens:
+            raise KeyError(prev_tokens)
+        return self.factory(zip(tokens, probs))
+
+    def __iter__(self):
+        return self.generator.contexts()
+
+    def __len__(self):
+        return sum(1 for _ in self.generator.contexts())
+
+
+class NGramGenerator(object):
+    """Random generation of sentences from an n-gram model.
+
+    Tokens are sampled hierarchically, following the smoothing of the model:
+    first the level of the context that generates the token is chosen by its
+    probability mass, then the token is drawn from the counts of that level.
+    No distribution over the whole vocabulary is ever built.
+
+    With top-k, top-p or temperature sampling, the distribution is the
+    tokens seen after the context at full order, sorted by decreasing
+    probability, followed by the unseen tokens as a single entry with the
+    rest of the probability, and the truncation is a binary search on their
+    cumulative probabilities. The temperature takes the unseen tokens as
+    sharing their probability evenly, and when they are drawn the token is
+    sampled from them by the model (see NGram.sample_unseen_id). If top-k
+    reaches the unseen tokens, the k most probable tokens are taken from the
+    shorter contexts as in beam search instead.
+    """
+
+    def __init__(self, model, cache_size=10000, seed=None, top_k=None,
+                 top_p=None, temperature=1.):
         """
         model -- n-gram model.
+        cache_size -- number of contexts whose tables are kept, the least
+            recently used are evicted (None for no limit).
+        seed -- seed of the random number generator (default: from the
+            system).
+        top_k -- if given, sample only from the k most probable tokens.
+        top_p -- if given, sample only from the most probable tokens whose
+            probabilities add up to p (nucleus sampling).
+        temperature -- probabilities are raised to 1 / temperature and
+            renormalized (default: 1).
         """
+        assert top_k is None or top_k > 0
+        assert top_p is None or 0. < top_p <= 1.
+        assert temperature > 0.
         self.model = model
-        self.probs = defaultdict(dict)
-        self.sorted_probs = defaultdict(list)
-        for tokens in self.model.counts:
-            if len(tokens) < self.model.n:
-                continue
-            prev_tokens = tokens[:-1]
-            token = tokens[-1]
-            prob = self.model.cond_prob(token, prev_tokens)
-            self.probs[prev_tokens][token] = prob
-            self.sorted_probs[prev_tokens].append((token, prob))
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.successor_table = lru_cache(maxsize=cache_size)(
+            self._build_successor_table)
+        self.context_table = lru_cache(maxsize=cache_size)(self._build_table)
+        self.beam_table = lru_cache(maxsize=cache_size)(
+            self._build_beam_table)
+        self.top_table = lru_cache(maxsize=cache_size)(self._build_top_table)
+        self.unigram_ranking = None
+
+    def _build_successor_table(self, ids, discount):
+        """Ids that follow a context (but <s>) and their cumulative weights,
+        the count minus the discount.
+
+        ids -- the context tuple of ids.
+        discount -- amount subtracted from every count.
+        """
+        start = self.model.vocab.ids[SENT_START]
+        successors = array('Q')
+        weights = []
+        for i, count in self.model.counts.successors(ids):
+            if i != start:
+                successors.append(i)
+                weights.append(count - discount)
+        return successors, array('d', accumulate(weights))
+
+    def draw(self, ids, discount=0.):
+        """Id of a token drawn from the tokens seen after a context, in
+        proportion to their discounted counts (None if there is none).
+
+        ids -- the context tuple of ids.
+        discount -- amount subtracted from every count (default: 0).
+        """
+        successors, cum_weights = self.successor_table(ids, discount)
+        if not successors or cum_weights[-1] <= 0.:
+            return None
+        i = bisect_right(cum_weights, self.rng.random() * cum_weights[-1])
+        return successors[min(i, len(successors) - 1)]
+
+    def uniform(self):
+        """Id of a token drawn uniformly from the vocabulary (but <s>).
+        """
+        start = self.model.vocab.ids[SENT_START]
+        i = int(self.rng.random() * self.model.V())
+        return i + (i >= start)
+
+    def _weights(self, probs):
+        """Probabilities after applying the temperature."""
+        if self.temperature == 1.:
+            return list(probs)
+        return [p ** (1. / self.temperature) for p in probs]
+
+    def _unseen_weight(self, probs, count=None):
+        """Weight of the tokens left out of a list of probabilities after
+        applying the temperature, taking them as sharing the rest of the
+        probability evenly.
+
+        probs -- the probabilities.
+        count -- if given, only the weight of this many of the tokens.
+        """
+        unseen = 1. - fsum(probs)
+        size = self.model.V() - len(probs)
+        if count is None or count > size:
+            count = size
+        # the rest is kept only beyond the rounding errors of the sum
+        if count <= 0 or unseen <= 1e-9:
+            return 0.
+        return count * self._weights([unseen / size])[0]
 
-        for prev_tokens in self.sorted_probs:
-            self.sorted_probs[prev_tokens].sort(key=lambda t: (-t[1], t[0]))
+    def _build_table(self, prev_tokens):
+        """Tokens seen after a context at full order, sorted by decreasing
+        probability, their probabilities and their cumulative probabilities
+        after applying the temperature. The cumulative probabilities have a
+        last entry for the unseen tokens.
+
+        prev_tokens -- the previous n-1 tokens.
+        """
+        model = self.model
+        tokens = model.vocab.tokens
+        ids = model.vocab.encode(prev_tokens)
+        token_probs = []
+        if ids is not None:
+            # the context is packed once for all its successors
+            key, known = model._context_key(prev_tokens)
+            successors = [i for i, _ in model.counts.successors(ids)]
+            probs = model._key_probs(repeat(key, len(successors)),
+                                     repeat(known, len(successors)),
+                                     successors)
+            token_probs = list(zip([tokens[i] for i in successors], probs))
+        token_probs.sort(key=lambda t: (-t[1], t[0]))
+
+        tokens = [t for t, _ in token_probs]
+        probs = array('d', [p for _, p in token_probs])
+        weights = self._weights(probs)
+        weights.append(self._unseen_weight(probs))
+        return tokens, probs, array('d', accumulate(weights))
+
+    def _build_top_table(self, prev_tokens):
+        """The top_k most probable tokens after a context, completed with
+        the tokens seen after its shorter suffixes (see beam_table), and
+        their cumulative probabilities after applying the temperature, with
+        a last entry for the rest of the k tokens if there are not enough.
+
+        prev_tokens -- the previous n-1 tokens.
+        """
+        table = self.beam_table(prev_tokens, self.top_k)
+        tokens = [t for t, _ in table]
+        probs = [p for _, p in table]
+        weights = self._weights(probs)
+        weights.append(self._unseen_weight(probs, self.top_k - len(tokens)))
+        return tokens, array('d', accumulate(weights))
+
+    def _build_beam_table(self, prev_tokens, width):
+        """Up to width (token, prob) pairs of the most probable tokens after
+        a context, by decreasing probability.
+
+        The tokens seen after the context at full order come first. If there
+        are less than width of them, the tokens seen after the shorter
+        suffixes of the context are added, from the longest suffix and by
+        decreasing count, scored with the whole context.
+
+        prev_tokens -- the previous n-1 tokens.
+        width -- number of tokens.
+        """
+        tokens, probs, _ = self.context_table(prev_tokens)
+        table = list(islice(zip(tokens, probs), width))
+        if len(table) == width:
+            return table
+
+        model = self.model
+        counts = model.counts
+        bits = counts.bits
+        mask = (1 << bits) - 1
+        key, known = model._context_key(prev_tokens)
+        ids = model.vocab.ids
+        seen = {ids[token] for token in tokens}
+        seen.add(ids[SENT_START])
+        added = []
+        for k in range(min(known, model.n - 1), -1, -1):
+            missing = width - len(table) - len(added)
+            if missing <= 0:
+                break
+            if not k:
+                ranked = (i for i in self._ranked_unigrams() if i not in seen)
+                added.extend(islice(ranked, missing))
+                break
+            start, end = counts.successor_range(
+                key & ((1 << bits * k) - 1), k)
+            keys, values = counts.keys.get(k + 1), counts.values.get(k + 1)
+            found = [(values[j], -(keys[j] & mask)) for j in range(start, end)
+                     if keys[j] & mask not in seen]
+            for _, i in nlargest(width - len(table) - len(added), found):
+                seen.add(-i)
+                added.append(-i)
+
+        vocab_tokens = model.vocab.tokens
+        probs = model._key_probs(repeat(key, len(added)),
+                                 repeat(known, len(added)), added)
+        table.extend(zip([vocab_tokens[i] for i in added], probs))
+        table.sort(key=lambda t: (-t[1], t[0]))
+        return table
+
+    def _ranked_unigrams(self):
+        """Ids of the tokens seen as unigrams by decreasing count, ranked
+        once for every context.
+        """
+        if self.unigram_ranking is None:
+            counts = self.model.counts
+            keys, values = counts.keys.get(1, ()), counts.values.get(1, ())
+            self.unigram_ranking = [
+                i for _, i in sorted(zip(map(neg, values), keys))]
+        return self.unigram_ranking
+
+    def contexts(self):
+        """Contexts with at least one token to generate.
+        """
+        counts = self.model.counts
+        for ids, _ in counts.id_items(self.model.n - 1):
+            if next(counts.successors(ids), None) is not None:
+                yield self.model.vocab.decode(ids)
+
+    @property
+    def sorted_probs(self):
+        """Mapping from every context at full order to the (token, prob)
+        list of the tokens seen after it, sorted by decreasing probability.
+        Each list is built on access, through the context cache.
+        """
+        return _ContextProbs(self, list)
+
+    @property
+    def probs(self):
+        """Mapping from every context at full order to a dict from the
+        tokens seen after it to their probabilities. Each dict is built on
+        access, through the context cache.
+        """
+        return _ContextProbs(self, dict)
+
+    def cache_info(self):
+        """Hits, misses, maximum and current size of the context cache.
+        """
+        if self.truncated():
+            return self.context_table.cache_info()
+        return self.successor_table.cache_info()
+
+    def truncated(self):
+        """Whether top-k, top-p or temperature sampling is used.
+        """
+        return self.top_k is not None or \
+            self.top_p is not None and self.top_p < 1. or \
+            self.temperature != 1.
+
+    def _sample_truncated(self, prev_tokens):
+        """Token sampled from the most probable tokens after a context (None
+        if the context has no probability).
+        """
+        tokens, _, cum_weights = self.context_table(prev_tokens)
+        end = len(cum_weights)
+        completed = False
+        if self.top_k is not None:
+            seen = cum_weights[-2] if tokens else 0.
+            if self.top_k <= len(tokens):
+                end = self.top_k
+            elif cum_weights[-1] > seen:
+                # the k most probable tokens include unseen ones
+                tokens, cum_weights = self.top_table(prev_tokens)
+                end = len(cum_weights)
+                completed = True
+        if not end or cum_weights[end - 1] <= 0.:
+            return None
+        if self.top_p is not None:
+            nucleus = bisect_left(cum_weights,
+                                  self.top_p * cum_weights[end - 1], 0, end)
+            end = min(end, nucleus + 1)
+        x = self.rng.random() * cum_weights[end - 1]
+        i = min(bisect_right(cum_weights, x, 0, end), end - 1)
+        if i < len(tokens):
+            return tokens[i]
+        model = self.model
+        ids = model.vocab.encode(prev_tokens)
+        while ids is not None:
+            i = model.sample_unseen_id(ids, self)
+            if i is None:
+                return None
+            token = model.vocab.tokens[i]
+            # the tokens completing the top k are not drawn again
+            if not completed or token not in tokens:
+                return token
+        return None
 
     def generate_sent(self):
         """Randomly generate a sentence."""
@@ -153,6 +1153,102 @@ class NGramGenerator(object):
 
         return result
 
+    def generate_batch(self, seed, size):
+        """Generate a batch of sentences from its own random stream.
+
+        seed -- seed of the stream of the batch.
+        size -- number of sentences.
+        """
+        self.rng = random.Random(seed)
+        return [self.generate_sent() for _ in range(size)]
+
+    def generate_sents(self, count, batch_size=1000, jobs=1):
+        """Generate sentences in batches, optionally in a pool of forked
+        processes that inherit the generator. The sentences are yielded as
+        their batches are done, in order.
+
+        Each batch has its own random stream, seeded from the seed of the
+        generator, so the sentences are the same for any number of jobs. At
+        most 2 * jobs batches are held in memory.
+
+        count -- number of sentences.
+        batch_size -- number of sentences per batch.
+        jobs -- number of worker processes (1 to generate in this process).
+        """
+        seeds = random.Random(self.seed)
+        batches = []
+        while count > 0:
+            size = min(count, batch_size)
+            batches.append((seeds.getrandbits(64), size))
+            count -= size
+
+        if jobs == 1:
+            for seed, size in batches:
+                yield from self.generate_batch(seed, size)
+            return
+
+        pending = deque()
+        with get_context('fork').Pool(jobs, _set_shared_generator,
+                                      (self,)) as pool:
+            for args in batches:
+                pending.append(pool.apply_async(_generate_batch, (args,)))
+                if len(pending) >= 2 * jobs:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+    def beam_search(self, prefix=(), k=5, beam_width=10, max_len=50,
+                    base=2.):
+        """Most probable completions of the beginning of a sentence, by beam
+        search over the tokens seen after each context.
+
+        At each step the hypotheses sharing a context are expanded together
+        with its beam_width most probable tokens, those seen after it at full
+        order or else after its shorter suffixes. The search ends when no
+        hypothesis in the beam can beat the k-th completion.
+
+        prefix -- list of tokens that begins the sentence.
+        k -- number of completions.
+        beam_width -- number of hypotheses kept at each step.
+        max_len -- maximum number of tokens of a completion.
+        base -- base of the logarithms.
+
+        Returns up to k (tokens, log_prob) pairs, the log probability being
+        that of the completion (followed by </s>) given the prefix, by
+        decreasing log probability.
+        """
+        n = self.model.n
+        prev_tokens = (SENT_START,) * (n - 1) + tuple(prefix)
+        prev_tokens = prev_tokens[len(prev_tokens) - n + 1:]
+        beam = [(0., (), prev_tokens)]
+        finished = []
+        log_base = log(base)
+
+        for _ in range(max_len + 1):
+            by_context = defaultdict(list)
+            for logp, tokens, prev_tokens in beam:
+                by_context[prev_tokens].append((logp, tokens))
+            candidates = []
+            for prev_tokens, hyps in by_context.items():
+                for token, p in self.beam_table(prev_tokens, beam_width):
+                    if p <= 0.:
+                        break
+                    token_logp = log(p) / log_base
+                    for logp, tokens in hyps:
+                        if token == SENT_END:
+                            finished.append((logp + token_logp, tokens))
+                        else:
+                            candidates.append((
+                                logp + token_logp, tokens + (token,),
+                                (prev_tokens + (token,))[1:]))
+            finished = nlargest(k, finished, key=itemgetter(0))
+            beam = nlargest(beam_width, candidates, key=itemgetter(0))
+            if not beam or \
+                    len(finished) == k and beam[0][0] <= finished[-1][0]:
+                break
+
+        return [(list(tokens), logp) for logp, tokens in finished]
+
     def generate_token(self, prev_tokens=None):
         """Randomly generate a token, given prev_tokens.
 
@@ -162,15 +1258,17 @@ class NGramGenerator(object):
         prev_tokens = tuple(prev_tokens)
         assert len(prev_tokens) == self.model.n - 1
 
-        target = random.random()
-        acum = 0.
-
-        for token, prob in self.sorted_probs[prev_tokens]:
-            acum += prob
-            if acum > target:
+        if self.truncated():
+            token = self._sample_truncated(prev_tokens)
+            if token is not None:
                 return token
 
-        assert 0
+        model = self.model
+        ids = model.vocab.encode(prev_tokens)
+        assert ids is not None
+        i = model.sample_id(ids, self)
+        assert i is not None
+        return model.vocab.tokens[i]
 
 
 class AddOneNGram(NGram):
@@ -182,213 +1280,855 @@ class AddOneNGram(NGram):
         prev_tokens -- the previous n-1 tokens (optional only if n = 1).
         """
         prev_tokens = prev_tokens or ()
-        prev_tokens = tuple(prev_tokens)
         assert len(prev_tokens) == self.n - 1
-        tokens = prev_tokens + (token,)
-        return float(self.count(tokens)+1) / (self.count(prev_tokens)+self.V())
+        key, known = self._context_key(prev_tokens)
+        return self._key_prob(key, known, self.vocab.ids.get(token, -1))
+
+    def _key_prob(self, key, known, i):
+        counts = self.counts
+        count = hit = 0
+        if known == self.n - 1:
+            count = counts.get_key(key, self.n - 1)
+            hit = counts.get_key(key << counts.bits | i, self.n)
+        return float(hit+1) / (count+self.V())
+
+    def _bind_key_probs(self):
+        n = self.n
+        bits = self.counts.bits
+        counts = self.counts.indexes(n + 1)
+        contexts, ngrams = counts[n - 1], counts[n]
+        vocab_size = self.V()
+
+        def key_probs(keys, knowns, ids):
+            probs = []
+            for key, known, i in zip(keys, knowns, ids):
+                count = hit = 0
+                if known == n - 1:
+                    count = contexts.get(key, 0)
+                    hit = ngrams.get(key << bits | i, 0)
+                probs.append(float(hit+1) / (count+vocab_size))
+            return probs
+
+        return key_probs
+
+    def sample_id(self, prev_ids, generator):
+        return self._sample_addone(prev_ids, generator)
+
+    def sample_unseen_id(self, prev_ids, generator):
+        return self._sample_unseen_addone(prev_ids, generator)
 
 
 class InterpolatedNGram(NGram):
 
     GAMMA_CANDIDATES = [1.5 ** x for x in range(-5, 30)]
+    PARAMS = NGram.PARAMS + ('gamma', 'addone')
+    SCORING_PARAMS = NGram.SCORING_PARAMS + ('gamma', 'addone')
+    ALL_ORDERS = True
 
-    def __init__(self, n, sents, gamma=None, addone=True):
+    def __init__(self, n, sents, gamma=None, addone=True, jobs=1,
+                 max_counts=None):
         """
         n -- order of the model.
-        sents -- list of sentences, each one being a list of tokens.
+        sents -- iterable of sentences, each one being a list of tokens.
         gamma -- interpolation hyper-parameter (if not given, estimate using
             held-out data).
         addone -- whether to use addone smoothing (default: True).
+        jobs -- number of processes used for counting (default: 1).
+        max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
         """
         assert n > 0
         self.n = n
-        self.counts = defaultdict(int)
-        self.set_vocab_size(sents)
-        heldout_set = []
-
-        for i, sent in enumerate(sents):
-            if gamma is None and i % 10 == 1:
-                # held out
-                heldout_set.append(sent)
-            else:
-                # train
-                sent = [SENT_START] * (n-1) + sent + [SENT_END]
-                for j in range(n+1):
-                    for i in range(n-j, len(sent) - j + 1):
-                        ngram = tuple(sent[i: i + j])
-                        self.counts[ngram] += 1
-                for j in range(1, n):
-                    self.counts[(SENT_START,)*j] += 1
-
+        heldout_counts = self._train(sents, all_orders=self.ALL_ORDERS,
+                                     heldout=gamma is None, jobs=jobs,
+                                     max_counts=max_counts)
         self.addone = addone
 
         self.gamma = gamma
         if self.gamma is None:
-            best_gamma = None
-            best_perp = float("inf")
-            for gamma in InterpolatedNGram.GAMMA_CANDIDATES:
-                self.gamma = gamma
-                perp = self.perplexity(heldout_set)
-                if best_gamma is None or perp < best_perp:
-                    best_perp = perp
-                    best_gamma = gamma
-            self.gamma = best_gamma
+            self._tune('gamma', self.GAMMA_CANDIDATES, heldout_counts,
+                       log_scale=True)
+
+    def update(self, sents, retune=False, jobs=1, max_counts=None):
+        """Add sentences to the training data, with the same counts as
+        training again on the whole corpus.
+
+        sents -- iterable of sentences, each one being a list of tokens.
+        retune -- estimate gamma again, using the held-out data of the new
+            sentences (only if gamma was estimated in training).
+        jobs -- number of processes used for counting (default: 1).
+        max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
+        """
+        assert not retune or self.heldout
+        heldout_counts = self._add_sents(sents, self.ALL_ORDERS, jobs,
+                                         max_counts)
+        if retune:
+            self._tune('gamma', self.GAMMA_CANDIDATES, heldout_counts,
+                       log_scale=True)
 
     def cond_prob(self, token, prev_tokens=None):
         """Conditional probability of a token.
 
         token -- the token.
-        prev_tokens -- the previous n-1 tokens (optional only if n = 1).
+        prev_tokens -- the previous n-1 tokens (optional only if n = 1). Less
+            tokens can be given to use the interpolation of the lower orders.
         """
         prev_tokens = prev_tokens or ()
-        prev_tokens = tuple(prev_tokens)
-        assert len(prev_tokens) == self.n - 1
-
-        lambdas = self._lambdas_from_prev_tokens(prev_tokens)
-
+        assert len(prev_tokens) < self.n
+        key, known = self._context_key(prev_tokens)
+        return self._key_prob(key, known, self.vocab.ids.get(token, -1),
+                              len(prev_tokens))
+
+    def _key_prob(self, key, known, i, k=None):
+        return self._bound_key_probs()((key,), (known,), (i,), k)[0]
+
+    def _bind_key_probs(self):
+        n = self.n
+        bits = self.counts.bits
+        counts = self.counts.indexes(n + 1)
+        masks = [(1 << bits * k) - 1 for k in range(n)]
+        gamma = self.gamma
+        addone = self.addone
+        vocab_size = self.V()
+        total = counts[0].get(0, 0)
+        unigrams = counts[1]
+
+        def interpolate(keys, knowns, ids, top=None):
+            # sum of lambda * the maximum-likelihood probability of each
+            # suffix of the context, from the longest; the unseen suffixes
+            # have a lambda of 0
+            if top is None:
+                top = n - 1
+            probs = []
+            for key, known, i in zip(keys, knowns, ids):
+                prob = 0.
+                lambda_sum = 0.
+                for k in range(min(known, top), 0, -1):
+                    key &= masks[k]
+                    count = counts[k].get(key, 0)
+                    if count:
+                        weight = (1-lambda_sum) * count / (count+gamma)
+                        prob += weight * (float(
+                            counts[k + 1].get(key << bits | i, 0)) / count)
+                        lambda_sum += weight
+                if addone:
+                    unigram = (unigrams.get(i, 0)+1)/(total + vocab_size)
+                else:
+                    unigram = float(unigrams.get(i, 0)) / total if total \
+                        else 0
+                probs.append(prob + (1-lambda_sum) * unigram)
+            return probs
+
+        return interpolate
+
+    def _suffix_counts(self, key, known, k):
+        """Counts of the suffixes of a context, from the longest to the
+        empty one.
+
+        key -- packed key of the context.
+        known -- how many of the last tokens of the context are in the
+            vocabulary.
+        k -- number of tokens of the context.
+        """
+        known = min(known, k)
+        # the suffixes with an unknown token are unseen
+        return [0] * (k - known) + self.counts.suffix_counts(key, known)
+
+    def _ml_probs(self, key, i, k, suffix_counts):
+        """Maximum-likelihood probabilities of a token for each suffix of a
+        context, from the longest (add-one for the unigram if enabled).
+
+        key -- packed key of the context.
+        i -- id of the token, -1 if unknown.
+        k -- number of tokens of the context.
+        suffix_counts -- counts of the suffixes of the context.
+        """
+        counts = self.counts
+        bits = counts.bits
         probs = [
-            float(self.count(prev_tokens[i:]+(token,)))
-            / self.count(prev_tokens[i:])
-            if self.count(prev_tokens[i:]) else 0
-            for i in range(self.n)
+            float(counts.get_key((key & ((1 << bits * j) - 1)) << bits | i,
+                                 j + 1)) / count
+            if count else 0
+            for j, count in zip(range(k, -1, -1), suffix_counts)
         ]
         if self.addone:
-            probs[-1] = (self.count((token,))+1)/(self.count(()) + self.V())
-        return sum(l*p for l, p in zip(lambdas, probs))
+            probs[-1] = (counts.get_key(i, 1)+1)/(suffix_counts[-1] + self.V())
+        return probs
 
     def _lambdas_from_prev_tokens(self, prev_tokens):
         """Lambdas to be used as interpolation weights
         """
+        key, known = self._context_key(prev_tokens)
+        counts = self._suffix_counts(key, known, len(prev_tokens))
+        return self._lambdas(counts[:-1])
+
+    def _lambdas(self, counts):
+        """Lambdas from the counts of the suffixes of the context.
+        """
         lambdas = []
         lambda_sum = 0.
-        for i in range(0, self.n-1):
-            cnt = self.count(prev_tokens[i:])
+        for cnt in counts:
             lambdas.append((1-lambda_sum) * cnt / (cnt+self.gamma))
             lambda_sum += lambdas[-1]
         lambdas.append(1-lambda_sum)
         return lambdas
 
+    def sample_id(self, prev_ids, generator):
+        """Id of a token sampled from the distribution after a context.
+
+        The suffix of the context is chosen with its lambda as probability,
+        and the token from the maximum-likelihood estimate of that suffix.
+
+        prev_ids -- tuple of ids of the previous n-1 tokens.
+        generator -- the NGramGenerator, that draws from the counts.
+        """
+        counts = [self.counts.get(prev_ids[i:]) for i in range(len(prev_ids))]
+        cum_lambdas = list(accumulate(self._lambdas(counts)))
+        i = bisect_right(cum_lambdas, generator.rng.random())
+        return self._sample_suffix(prev_ids, i, generator)
+
+    def sample_unseen_id(self, prev_ids, generator):
+        """Id of a token sampled from the distribution after a context,
+        among the tokens not seen after it at full order.
+
+        The suffix is chosen as in sample_id, but for the whole context,
+        that only gives seen tokens, until the token drawn is an unseen one.
+
+        prev_ids -- tuple of ids of the previous n-1 tokens.
+        generator -- the NGramGenerator, that draws from the counts.
+        """
+        counts = [self.counts.get(prev_ids[i:]) for i in range(len(prev_ids))]
+        first = 1 if prev_ids else 0
+        cum_lambdas = list(accumulate(self._lambdas(counts)[first:]))
+        if not cum_lambdas[-1] > 0.:
+            return None
+        while True:
+            x = generator.rng.random() * cum_lambdas[-1]
+            i = self._sample_suffix(
+                prev_ids, first + bisect_right(cum_lambdas, x), generator)
+            if i is None or not self.counts.get(prev_ids + (i,)):
+                return i
+
+    def _sample_suffix(self, prev_ids, i, generator):
+        """Id of a token drawn from the estimate of the suffix of the context
+        that starts at i, the last one being the unigrams.
+        """
+        if i < len(prev_ids):
+            return generator.draw(prev_ids[i:])
+        if self.addone:
+            return self._sample_addone((), generator)
+        return generator.draw(())
+
+    def _event_stats(self, key, known, i):
+        """Counts of the seen suffixes of the context, from the longest,
+        paired with the maximum-likelihood probabilities of the token after
+        them, and the probability of the token in the last order.
+        """
+        k = self.n - 1
+        suffix_counts = self._suffix_counts(key, known, k)
+        probs = self._ml_probs(key, i, k, suffix_counts)
+        return ([(count, prob) for count, prob in
+                 zip(suffix_counts[:-1], probs) if count], probs[-1])
+
+    def _stats_prob(self, stats):
+        # as _lambdas(), skipping the unseen suffixes, whose lambda is 0
+        levels, last = stats
+        gamma = self.gamma
+        prob = 0.
+        lambda_sum = 0.
+        for count, ml_prob in levels:
+            weight = (1-lambda_sum) * count / (count+gamma)
+            prob += weight * ml_prob
+            lambda_sum += weight
+        return prob + (1-lambda_sum) * last
+
+    def backoff_weight(self, tokens):
+        """Weight of the lower orders for a k-gram context with 0 < k < n.
+
+        The interpolation for the context x1..xk is
+        (1 - w) * c(x1..xkx) / c(x1..xk) + w * P(x | x2..xk), with w the
+        weight returned.
+
+        tokens -- the k-gram tuple.
+        """
+        cnt = self.count(tokens)
+        if not cnt:
+            return 1.
+        return self.gamma / (cnt + self.gamma)
+
 
 class BackOffNGram(NGram):
 
     BETA_CANDIDATES = [0.05 * x for x in range(21)]
-
-    def __init__(self, n, sents, beta=None, addone=True):
+    PARAMS = NGram.PARAMS + ('beta', 'addone')
+    SCORING_PARAMS = NGram.SCORING_PARAMS + ('beta', 'addone')
+    TABLES = NGram.TABLES + ('card_a', 'sum_c', 'alphas', 'denoms',
+                             'pruned')
+    COUNT_TABLES = NGram.COUNT_TABLES + ('pruned',)
+    ALL_ORDERS = True
+
+    # alpha and denom of the seen contexts, filled by finalize()
+    alphas = None
+    denoms = None
+    # sum of the counts of the pruned n-grams of each context, filled by
+    # prune()
+    pruned = None
+
+    def __init__(self, n, sents, beta=None, addone=True, jobs=1,
+                 max_counts=None):
         """
             Back-off NGram model with discounting
             as described by Michael Collins.
 
             n -- order of the model.
-            sents -- list of sentences, each one being a list of tokens.
+            sents -- iterable of sentences, each one being a list of tokens.
             beta -- discounting hyper-parameter (if not given, estimate using
             held-out data).
             addone -- whether to use addone smoothing (default: True).
+            jobs -- number of processes used for counting (default: 1).
+            max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
         """
         assert n > 0
         self.n = n
-        self.counts = defaultdict(int)
-        self.set_vocab_size(sents)
-        heldout_set = []
-
-        for i, sent in enumerate(sents):
-            if beta is None and i % 10 == 1:
-                # held out
-                heldout_set.append(sent)
-            else:
-                # train
-                sent = [SENT_START] * (n-1) + sent + [SENT_END]
-                for j in range(n+1):
-                    for i in range(n-j, len(sent) - j + 1):
-                        ngram = tuple(sent[i: i + j])
-                        self.counts[ngram] += 1
-                for j in range(1, n):
-                    self.counts[(SENT_START,)*j] += 1
-
-        # |A(x1..xi)|
-        self.card_a = defaultdict(int)
-        # sum(c(x2..xix) for x in A(x1..xi))
-        self.sum_c = defaultdict(int)
-
-        for tokens in self.counts:
-            if len(tokens):
-                if tokens[-1] == SENT_START:
-                    continue
-                prev_tokens = tokens[:-1]
-                self.card_a[prev_tokens] += 1
-                self.sum_c[prev_tokens] += self.count(tokens[1:])
+        heldout_counts = self._train(sents, all_orders=self.ALL_ORDERS,
+                                     heldout=beta is None, jobs=jobs,
+                                     max_counts=max_counts)
+        self._count_successors()
 
         self.addone = addone
 
         self.beta = beta
         if self.beta is None:
-            best_beta = None
-            best_perp = float("inf")
-            for beta in BackOffNGram.BETA_CANDIDATES:
-                self.beta = beta
-                perp = self.perplexity(heldout_set)
-                if best_beta is None or perp < best_perp:
-                    best_perp = perp
-                    best_beta = beta
-            self.beta = best_beta
+            self._tune('beta', self.BETA_CANDIDATES, heldout_counts)
+
+    def _count_successors(self):
+        """Build the card_a and sum_c tables from the counts.
+
+        The successors of a prefix are contiguous in the sorted keys, so the
+        tables of each order are built by C loops over them: card_a counts
+        the keys of each prefix and sum_c is a difference of the cumulative
+        sums of their suffix counts.
+        """
+        counts = self.counts
+        bits = counts.bits
+        mask = (1 << bits) - 1
+        start = self.vocab.ids[SENT_START]
+        # |A(x1..xi)|
+        card_a = CountTable(self.vocab)
+        # sum(c(x2..xix) for x in A(x1..xi)), fractional if the counts are
+        # (see merge)
+        sum_c = CountTable(self.vocab, typecode=counts.typecode)
+        for order in counts.orders():
+            if not order:
+                continue
+            keys = counts.keys[order]
+            # <s> never follows a prefix
+            keys = list(compress(keys, map(start.__ne__,
+                                           map(and_, keys, repeat(mask)))))
+            successors = Counter(map(rshift, keys, repeat(bits)))
+            suffix_mask = (1 << bits * (order - 1)) - 1
+            suffix_counts = counts.get_keys(
+                map(and_, keys, repeat(suffix_mask)), order - 1)
+            cumulative = [0]
+            cumulative.extend(accumulate(suffix_counts))
+            ends = [0]
+            ends.extend(accumulate(successors.values()))
+            ends = list(map(cumulative.__getitem__, ends))
+            prefixes = list(successors)
+            card_a.set_order(order - 1, prefixes, successors.values(),
+                             is_sorted=True)
+            sum_c.set_order(order - 1, prefixes, map(sub, ends[1:], ends),
+                            is_sorted=True)
+
+        self.card_a = card_a
+        self.sum_c = sum_c
+        if self.pruned is not None and self.pruned.bits != self.counts.bits:
+            # the vocabulary grew, pack the keys as the counts
+            self.pruned = CountTable(self.vocab, dict(self.pruned.id_items()),
+                                     self.pruned.typecode)
+
+    def update(self, sents, retune=False, jobs=1, max_counts=None):
+        """Add sentences to the training data, with the same counts as
+        training again on the whole corpus.
+
+        The card_a and sum_c tables are rebuilt from the merged counts, and
+        the alpha and denom tables too if the model was finalized. They are
+        not updated in place: sum_c adds the counts of the suffixes of the
+        successors, that change for most of the contexts, and the sorted
+        arrays of every table are built again anyway.
+
+        sents -- iterable of sentences, each one being a list of tokens.
+        retune -- estimate beta again, using the held-out data of the new
+            sentences (only if beta was estimated in training).
+        jobs -- number of processes used for counting (default: 1).
+        max_counts -- if given, number of distinct n-grams kept in memory
+            while counting, the rest are spilled to temporary files.
+        """
+        assert not retune or self.heldout
+        heldout_counts = self._add_sents(sents, self.ALL_ORDERS, jobs,
+                                         max_counts)
+        finalized = self.alphas is not None
+        self.alphas = self.denoms = None
+        self._count_successors()
+        if retune:
+            self._tune('beta', self.BETA_CANDIDATES, heldout_counts)
+        if finalized:
+            self.finalize()
+
+    def _counts_changed(self):
+        """Build again card_a and sum_c, and the alpha and denom tables if
+        the model was finalized.
+        """
+        finalized = self.alphas is not None
+        self.alphas = self.denoms = None
+        self._count_successors()
+        if finalized:
+            self.finalize()
 
     def A(self, tokens):
         """Set of words with counts > 0 for a k-gram with 0 < k < n.
 
         tokens -- the k-gram tuple.
         """
-        # Inefficient, but used only in tests
-        result = set()
-        for tokens_suc in self.counts:
-            if tokens_suc[:-1] == tokens and len(tokens_suc):
-                result.add(tokens_suc[-1])
-        return result
+        ids = self.vocab.encode(tokens)
+        if ids is None:
+            return set()
+        tokens = self.vocab.tokens
+        return {tokens[i] for i, _ in self.counts.successors(ids)}
+
+    def freeze(self):
+        """Make the model read-only, see NGram.freeze(). It is finalized
+        first if it wasn't.
+        """
+        if self.alphas is None:
+            self.finalize()
+        super().freeze()
+
+    def finalize(self):
+        """Precompute alpha and denom for every seen k-gram with 0 < k < n.
+
+        Back-off then takes a table read instead of several count lookups.
+        It must be called again if beta changes.
+        """
+        self.alphas = self.denoms = None
+        counts = self.counts
+        bits = counts.bits
+        alphas = CountTable(self.vocab, typecode='d')
+        denoms = CountTable(self.vocab, typecode='d')
+        for k in range(1, self.n):
+            keys = counts.keys.get(k)
+            if keys is None:
+                continue
+            values = counts.values[k]
+            card_a = self.card_a.get_keys(keys, k)
+            if self.pruned is not None:
+                pruned = self.pruned.get_keys(keys, k)
+            else:
+                pruned = repeat(0)
+            sum_c = self.sum_c.get_keys(keys, k)
+            suffix_mask = (1 << bits * (k - 1)) - 1
+            suffix_counts = counts.get_keys(
+                map(and_, keys, repeat(suffix_mask)), k - 1)
+            alphas.set_order(k, keys, map(self._alpha, values, card_a, pruned),
+                             is_sorted=True)
+            denoms.set_order(k, keys, map(self._denom, repeat(k), values,
+                                          card_a, sum_c, suffix_counts),
+                             is_sorted=True)
+        self.alphas, self.denoms = alphas, denoms
+
+    def prune(self, min_counts=None, threshold=None):
+        """Remove n-grams of order 2 or more, leaving their probability to
+        the back-off of their contexts. The count of the removed n-grams is
+        kept in the pruned table, so alpha and denom are computed from the
+        remaining ones and the distributions still add up to 1.
+
+        An n-gram is kept while it is the context or the suffix of a kept
+        longer one.
+
+        min_counts -- dict from orders to the minimum count of the kept
+            n-grams of that order. The minimum of an order is at least that of
+            the lower ones.
+        threshold -- if given, also remove the n-grams whose removal alone
+            increases the relative entropy of the model less than this
+            (Stolcke pruning).
+
+        Returns the number of n-grams removed.
+        """
+        counts = self.counts
+        total = counts.get(())
+        minimums = {}
+        minimum = 0
+        for order in range(2, self.n + 1):
+            minimum = max(minimum, (min_counts or {}).get(order, 0))
+            minimums[order] = minimum
+
+        removed = set()
+        for order in range(self.n, 1, -1):
+            protected = set()
+            for ids, _ in counts.id_items(order + 1):
+                if ids not in removed:
+                    protected.add(ids[:-1])
+                    protected.add(ids[1:])
+            for ids, count in counts.id_items(order):
+                if ids in protected:
+                    continue
+                if count < minimums[order] or threshold is not None and \
+                        self._prune_cost(ids, count, total) < threshold:
+                    removed.add(ids)
+        if not removed:
+            return 0
+
+        pruned = defaultdict(int)
+        if self.pruned is not None:
+            pruned.update(self.pruned.id_items())
+        for ids in removed:
+            pruned[ids[:-1]] += counts.get(ids)
+        self.counts = CountTable.from_sorted(
+            self.vocab,
+            ((ids, c) for ids, c in counts.id_items() if ids not in removed))
+        self.pruned = CountTable(self.vocab, pruned)
+        self._counts_changed()
+        return len(removed)
+
+    def _prune_cost(self, ids, count, total):
+        """Relative entropy between the model and the model without an
+        n-gram, estimating the probability of its context by its relative
+        frequency.
+        """
+        tokens = self.vocab.decode(ids)
+        prev_tokens, token = tokens[:-1], tokens[-1]
+        prob = (count - self.beta) / self.count(prev_tokens)
+        if prob <= 0.:
+            return 0.
+        lower = self.cond_prob(token, prev_tokens[1:])
+        alpha = self.alpha(prev_tokens)
+        denom = self.denom(prev_tokens)
+        # alpha and denom once the n-gram is backed off
+        new_alpha = alpha + prob
+        new_denom = denom + lower
+        new_prob = new_alpha * lower / new_denom if new_denom > 0. else 0.
+        if new_prob <= 0.:
+            return float('inf')
+        cost = prob * log(prob / new_prob)
+        if alpha > 0. and denom > 0.:
+            # the backed-off tokens of the context change weight
+            cost += alpha * log(alpha / denom * new_denom / new_alpha)
+        return self.count(prev_tokens) / total * cost
 
     def alpha(self, tokens):
         """Missing probability mass for a k-gram with 0 < k < n.
 
         tokens -- the k-gram tuple.
         """
-        if not self.count(tokens):
+        if self.alphas is not None:
+            return self.alphas.lookup(tokens, 1.)
+        return self._alpha(self.count(tokens), self.card_a[tokens],
+                           self.pruned_count(tokens))
+
+    def _alpha(self, count, card_a, pruned=0):
+        if not count:
             return 1.
-        return self.beta * self.card_a[tokens] / self.count(tokens)
+        return (self.beta * card_a + pruned) / count
+
+    def pruned_count(self, tokens):
+        """Sum of the counts of the pruned n-grams that follow a k-gram.
+
+        tokens -- the k-gram tuple.
+        """
+        if self.pruned is None:
+            return 0
+        return self.pruned[tokens]
 
     def denom(self, tokens):
         """Normalization factor for a k-gram with 0 < k < n.
 
         tokens -- the k-gram tuple.
         """
-        if not self.count(tokens):
+        if self.denoms is not None:
+            return self.denoms.lookup(tokens, 1.)
+        count = self.count(tokens)
+        if not count:
             return 1.
         assert len(tokens)
-        if len(tokens) == 1:
+        return self._denom(len(tokens), count, self.card_a[tokens],
+                           self.sum_c[tokens], self.count(tokens[1:]))
+
+    def _denom(self, k, count, card_a, sum_c, suffix_count):
+        if not count:
+            return 1.
+        if k == 1:
             # In unigram level, do not discount
             if self.addone:
-                return 1 - float(self.sum_c[tokens]+self.card_a[tokens]) / \
-                    (self.count(tokens[1:]) + self.V())
+                return 1 - float(sum_c+card_a) / (suffix_count + self.V())
             else:
-                return 1 - float(self.sum_c[tokens])/self.count(tokens[1:])
+                return 1 - float(sum_c)/suffix_count
         else:
-            return 1 - (self.sum_c[tokens]-self.beta*self.card_a[tokens]) / \
-                self.count(tokens[1:])
+            return 1 - (sum_c-self.beta*card_a) / suffix_count
+
+    def _event_stats(self, key, known, i):
+        """Counts needed by _key_prob, walking the back-off chain: those of
+        the seen contexts backed off from, from the shortest, whether an
+        unseen one was backed off from, and the hit and context counts of
+        the first seen n-gram (a hit of 0 and the unigram probability if
+        there is none).
+        """
+        n = self.n
+        bits = self.counts.bits
+        counts = self.counts.indexes(n + 1)
+        card_a = self.card_a.indexes(n)
+        sum_c = self.sum_c.indexes(n)
+        pruned = self.pruned.indexes(n) if self.pruned is not None else None
+        levels = []
+        unseen = False
+        for k in range(n - 1, 0, -1):
+            key &= (1 << bits * k) - 1
+            if k > known:
+                # a context with an unknown token
+                unseen = True
+                continue
+            hit = counts[k + 1].get(key << bits | i)
+            count = counts[k].get(key, 0)
+            if hit:
+                return levels[::-1], unseen, hit, count
+            if not count:
+                unseen = True
+                continue
+            suffix = key & ((1 << bits * (k - 1)) - 1)
+            levels.append((k, count, card_a[k].get(key, 0),
+                           sum_c[k].get(key, 0), counts[k - 1].get(suffix, 0),
+                           pruned[k].get(key, 0) if pruned else 0))
+        return levels[::-1], unseen, 0, self._key_prob(0, 0, i, 0)
+
+    def _stats_prob(self, stats):
+        levels, unseen, hit, last = stats
+        beta = self.beta
+        if unseen and not beta > 0.:
+            # no residual probability, alpha = denom = 1 otherwise
+            return 0.
+        prob = (hit-beta)/last if hit else last
+        for k, count, card_a, sum_c, suffix_count, pruned in levels:
+            if not beta > 0. and not pruned:
+                return 0.
+            prob = self._alpha(count, card_a, pruned) * prob / \
+                self._denom(k, count, card_a, sum_c, suffix_count)
+        return prob
 
-    def cond_prob(self, token, prev_tokens=None):
-        prev_tokens = prev_tokens or ()
-        prev_tokens = tuple(prev_tokens)
-        tokens = prev_tokens + (token,)
-
-        if not len(prev_tokens):
-            # unigram
-            if not self.addone:
-                return float(self.count(tokens)) / self.count(prev_tokens)
-            return float(self.count(tokens)+1) / \
-                (self.count(prev_tokens) + self.V())
-
-        if self.count(tokens):
-            return (self.count(tokens)-self.beta)/self.count(prev_tokens)
-        elif self.beta > 0.:
-            return self.alpha(prev_tokens) * \
-                self.cond_prob(token, prev_tokens[1:]) / \
-                self.denom(prev_tokens)
+    def sample_id(self, prev_ids, generator):
+        """Id of a token sampled from the distribution after a context.
+
+        A seen token is drawn from the discounted counts with probability
+        1 - alpha, else the token is sampled from the shorter context until
+        it is not a seen one, which gives the back-off distribution divided
+        by denom.
+
+        prev_ids -- tuple of ids of the previous n-1 tokens.
+        generator -- the NGramGenerator, that draws from the counts.
+        """
+        if not prev_ids:
+            if self.addone:
+                return self._sample_addone((), generator)
+            return generator.draw(())
+
+        count = self.counts.get(prev_ids)
+        if count:
+            pruned = 0
+            if self.pruned is not None:
+                pruned = self.pruned.get(prev_ids)
+            alpha = self._alpha(count, self.card_a.get(prev_ids), pruned)
+            if generator.rng.random() >= alpha:
+                return generator.draw(prev_ids, self.beta)
+        elif not self.beta > 0.:
+            # no residual probability
+            return None
+        return self.sample_unseen_id(prev_ids, generator)
+
+    def sample_unseen_id(self, prev_ids, generator):
+        """Id of a token sampled from the distribution after a context,
+        among the tokens not seen after it at full order: the back-off
+        distribution divided by denom, as in sample_id.
+
+        prev_ids -- tuple of ids of the previous n-1 tokens.
+        generator -- the NGramGenerator, that draws from the counts.
+        """
+        if not prev_ids:
+            if self.addone:
+                return self._sample_unseen_addone((), generator)
+            return None
+
+        count = self.counts.get(prev_ids)
+        while True:
+            i = self.sample_id(prev_ids[1:], generator)
+            if i is None or not count or not self.counts.get(prev_ids + (i,)):
+                return i
+
+    def _key_prob(self, key, known, i, k=None):
+        """Conditional probability of a token after a context given by its
+        packed key, as cond_prob().
+
+        key -- packed key of the previous tokens.
+        known -- how many of the last previous tokens are in the vocabulary.
+        i -- id of the token, -1 if unknown.
+        k -- number of previous tokens used (default: n-1).
+        """
+        return self._bound_key_probs()((key,), (known,), (i,), k)[0]
+
+    def _bind_key_probs(self):
+        n = self.n
+        bits = self.counts.bits
+        counts = self.counts.indexes(n + 1)
+        masks = [(1 << bits * k) - 1 for k in range(n)]
+        beta = self.beta
+        # beta is None until tuned, when the unigrams are the only ones used
+        residual = beta is not None and beta > 0.
+        pruned = None
+        if self.pruned is not None:
+            pruned = self.pruned.indexes(n)
+        finalized = self.alphas is not None
+        if finalized:
+            alphas = self.alphas.indexes(n)
+            denoms = self.denoms.indexes(n)
         else:
-            # If beta is 0, there is no residual probability
+            card_a = self.card_a.indexes(n)
+            sum_c = self.sum_c.indexes(n)
+        total = counts[0].get(0, 0)
+        if self.addone:
+            total += self.V()
+        unigrams = counts[1]
+        addone = self.addone
+        _alpha, _denom = self._alpha, self._denom
+
+        def back_off(keys, knowns, ids, top=None):
+            # walk the back-off chain of each event down to the first seen
+            # n-gram, keeping the alpha and denom of each context, and weight
+            # the probability on the way back up as the recursive definition
+            # does
+            if top is None:
+                top = n - 1
+            probs = []
+            for key, known, i in zip(keys, knowns, ids):
+                weights = []
+                for k in range(top, 0, -1):
+                    key &= masks[k]
+                    if k > known:
+                        # a context with an unknown token, unseen: alpha =
+                        # denom = 1
+                        if not residual:
+                            prob = 0.
+                            weights = []
+                            break
+                        continue
+                    hit = counts[k + 1].get(key << bits | i)
+                    if hit:
+                        prob = (hit-beta)/counts[k].get(key)
+                        break
+                    removed = pruned is not None and pruned[k].get(key, 0)
+                    if not residual and not removed:
+                        # no residual probability
+                        prob = 0.
+                        weights = []
+                        break
+                    if finalized:
+                        weights.append((alphas[k].get(key, 1.),
+                                        denoms[k].get(key, 1.)))
+                    else:
+                        count = counts[k].get(key, 0)
+                        if count:
+                            card = card_a[k].get(key, 0)
+                            suffix = counts[k - 1].get(key & masks[k - 1], 0)
+                            weights.append((
+                                _alpha(count, card, removed or 0),
+                                _denom(k, count, card, sum_c[k].get(key, 0),
+                                       suffix)))
+                else:
+                    # unigram
+                    if addone:
+                        prob = float(unigrams.get(i, 0)+1) / total
+                    else:
+                        prob = float(unigrams.get(i, 0)) / total
+                for alpha, denom in reversed(weights):
+                    prob = alpha * prob / denom
+                probs.append(prob)
+            return probs
+
+        return back_off
+
+    def backoff_weight(self, tokens):
+        """Back-off weight alpha / denom for a k-gram with 0 < k < n.
+
+        tokens -- the k-gram tuple.
+        """
+        denom = self.denom(tokens)
+        if not denom:
+            # nothing left to back-off to
             return 0.
+        return self.alpha(tokens) / denom
+
+    def cond_prob(self, token, prev_tokens=None):
+        prev_tokens = prev_tokens or ()
+        key, known = self._context_key(prev_tokens)
+        return self._key_prob(key, known, self.vocab.ids.get(token, -1),
+                              len(prev_tokens))
+
+
+class ArpaNGram(NGram):
+
+    PARAMS = ('n', 'vocab_size')
+    TABLES = ('log_probs', 'log_bows')
+    COUNT_TABLES = ()
+
+    def __init__(self, f):
+        """Query-only back-off model read from a file in ARPA format.
+
+        f -- text file object.
+        """
+        self.n, self.vocab, self.log_probs, self.log_bows = read_arpa(f)
+        self.vocab_size = len(self.vocab) - 1  # every token but <s>
+
+    def _key_table(self):
+        return self.log_probs
+
+    def _bind_key_probs(self):
+        key_prob = self._key_prob
+
+        def key_probs(keys, knowns, ids):
+            return list(map(key_prob, keys, knowns, ids))
+
+        return key_probs
+
+    def _key_prob(self, key, known, i):
+        bits = self.log_probs.bits
+        log_bow = 0.
+        for k in range(min(known, self.n - 1), -1, -1):
+            if i < 0:
+                break
+            suffix = key & ((1 << bits * k) - 1)
+            log_prob = self.log_probs.get_key(suffix << bits | i, k + 1, None)
+            if log_prob is not None:
+                return 10. ** (log_bow + log_prob)
+            log_bow += self.log_bows.get_key(suffix, k, 0.)
+        return 0.
+
+    def cond_prob(self, token, prev_tokens=None):
+        """Conditional probability of a token.
+
+        Unknown tokens are mapped to <unk> if the model has it.
+
+        token -- the token.
+        prev_tokens -- the previous tokens (only the last n-1 are used).
+        """
+        prev_tokens = tuple(prev_tokens or ())
+        prev_tokens = prev_tokens[max(0, len(prev_tokens) - self.n + 1):]
+        ids = self.vocab.ids
+        unk = ids.get(UNK)
+        ngram = tuple([ids.get(t, unk) for t in prev_tokens + (token,)])
+
+        log_bow = 0.
+        for i in range(len(ngram)):
+            if None not in ngram[i:]:
+                log_prob = self.log_probs.get(ngram[i:], None)
+                if log_prob is not None:
+                    return 10. ** (log_bow + log_prob)
+                log_bow += self.log_bows.get(ngram[i:-1], 0.)
+        return 0.
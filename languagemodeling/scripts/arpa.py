@@ -0,0 +1,37 @@
+"""Convert language models from and to ARPA format.
+
+Usage:
+  arpa.py export -i <file> -o <file>
+  arpa.py import -i <file> -o <file>
+  arpa.py -h | --help
+
+Options:
+  -i <file>     Input file: a model file to export or an ARPA file to import.
+  -o <file>     Output file: an ARPA file or a model file.
+  -h --help     Show this screen.
+"""
+from docopt import docopt
+
+import os.path
+import sys
+# Add ../../ to PYTHONPATH
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        os.pardir, os.pardir))
+
+from languagemodeling.ngram import NGram, ArpaNGram
+from languagemodeling.arpa import write_arpa
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    if opts['export']:
+        model = NGram.load(opts['-i'])
+        with open(opts['-o'], 'w') as f:
+            write_arpa(model, f)
+    else:
+        with open(opts['-i']) as f:
+            model = ArpaNGram(f)
+        model.save(opts['-o'])
@@ -1,15 +1,16 @@
 """Evaulate a language model using the test set.
 
 Usage:
-  eval.py -i <file>
+  eval.py -i <file> [-j <jobs>]
   eval.py -h | --help
 
 Options:
   -i <file>     Language model file.
+  -j <jobs>, --jobs <jobs>
+                Number of processes used for scoring [default: 1].
   -h --help     Show this screen.
 """
 from docopt import docopt
-import pickle
 
 from nltk.corpus import PlaintextCorpusReader
 
@@ -21,13 +22,14 @@ sys.path.append(
         os.path.dirname(os.path.realpath(__file__)),
         os.pardir, os.pardir))
 
+from languagemodeling.ngram import NGram
+
+
 if __name__ == '__main__':
     opts = docopt(__doc__)
 
     # load the model
-    filename = opts['-i']
-    with open(filename, 'rb') as f:
-        model = pickle.load(f)
+    model = NGram.load(opts['-i'])
 
     # load the test set
     corpus = PlaintextCorpusReader(
@@ -36,8 +38,12 @@ if __name__ == '__main__':
     )
     sents = corpus.sents()
 
-    logp, cross_entropy, perplexity = model.logp_entropy_perplexity(sents)
+    jobs = int(opts['--jobs'])
+    if jobs > 1:
+        scores = model.parallel_score_sents(sents, jobs)
+    else:
+        scores = model.score_sents(sents)
 
-    print('Log probability: %s' % logp)
-    print('Cross entropy: %s' % cross_entropy)
-    print('Perplexity: %s' % perplexity)
+    print('Log probability: %s' % scores.log_prob)
+    print('Cross entropy: %s' % scores.cross_entropy)
+    print('Perplexity: %s' % scores.perplexity)
@@ -1,16 +1,31 @@
 """Generate natural language sentences using a language model.
 
 Usage:
-  generate.py -i <file> -n <n>
+  generate.py -i <file> -n <n> [-c <n>] [-s <seed>] [-j <n>] [-b <n>]
+              [-k <k>] [-p <p>] [-t <t>]
   generate.py -h | --help
 
 Options:
   -i <file>     Language model file.
   -n <n>        Number of sentences to generate.
+  -c <n>, --cache <n>
+                Number of contexts whose tables are kept [default: 10000].
+  -s <seed>, --seed <seed>
+                Seed of the random number generator.
+  -j <n>, --jobs <n>
+                Number of processes used for generation [default: 1].
+  -b <n>, --batch-size <n>
+                Number of sentences per batch [default: 1000].
+  -k <k>, --top-k <k>
+                Sample only from the k most probable tokens.
+  -p <p>, --top-p <p>
+                Sample only from the most probable tokens whose probabilities
+                add up to p.
+  -t <t>, --temperature <t>
+                Sampling temperature [default: 1.0].
   -h --help     Show this screen.
 """
 from docopt import docopt
-import pickle
 
 import os.path
 import sys
@@ -20,20 +35,29 @@ sys.path.append(
         os.path.dirname(os.path.realpath(__file__)),
         os.pardir, os.pardir))
 
-from languagemodeling.ngram import NGramGenerator
+from languagemodeling.ngram import NGram, NGramGenerator
 
 
 if __name__ == '__main__':
     opts = docopt(__doc__)
     # load the model
-    filename = opts['-i']
-    with open(filename, 'rb') as f:
-        model = pickle.load(f)
+    model = NGram.load(opts['-i'])
     sys.stderr.write('Loaded model\n')
     # generate
     n = int(opts['-n'])
-    generator = NGramGenerator(model)
+    seed = opts['--seed']
+    top_k = opts['--top-k']
+    top_p = opts['--top-p']
+    generator = NGramGenerator(
+        model, int(opts['--cache']),
+        seed=int(seed) if seed is not None else None,
+        top_k=int(top_k) if top_k is not None else None,
+        top_p=float(top_p) if top_p is not None else None,
+        temperature=float(opts['--temperature']))
     sys.stderr.write('Initialized generator\n')
-    for i in range(n):
+    sents = generator.generate_sents(n, int(opts['--batch-size']),
+                                     int(opts['--jobs']))
+    for i, sent in enumerate(sents):
         print('Sentence %s:' % i)
-        print(' '.join(generator.generate_sent()))
+        print(' '.join(sent))
+    sys.stderr.write('Context cache: %s\n' % (generator.cache_info(),))
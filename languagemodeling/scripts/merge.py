@@ -0,0 +1,50 @@
+"""Merge n-gram models trained on different corpora.
+
+Usage:
+  merge.py [-w <weights>] [-M <n>] -o <file> <model>...
+  merge.py -h | --help
+
+Options:
+  -w <weights>  Comma separated factors of the counts of each model, negative
+                to subtract (default: 1 for every model).
+  -M <n>, --max-counts <n>
+                Number of entries of a table sorted again in memory, the rest
+                are spilled to temporary files (default: no limit).
+  -o <file>     Output model file.
+  -h --help     Show this screen.
+"""
+from docopt import docopt
+
+import os.path
+import sys
+# Add ../../ to PYTHONPATH
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        os.pardir, os.pardir))
+
+from languagemodeling.ngram import NGram, BackOffNGram
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    # the models are mapped, their tables are read as sorted streams
+    models = [NGram.load(filename) for filename in opts['<model>']]
+    weights = None
+    if opts['-w']:
+        weights = [float(w) for w in opts['-w'].split(',')]
+        if len(weights) != len(models):
+            print('There must be a weight for each model')
+            exit(1)
+    max_counts = opts['--max-counts'] and int(opts['--max-counts'])
+
+    try:
+        model = NGram.merge(models, weights, max_counts)
+    except ValueError as e:
+        print(e)
+        exit(1)
+    if isinstance(model, BackOffNGram):
+        model.finalize()
+    # save it
+    model.save(opts['-o'])
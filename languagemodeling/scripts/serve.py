@@ -0,0 +1,49 @@
+"""Serve a language model over HTTP, scoring sentences in micro-batches.
+
+Usage:
+  serve.py -i <file> [-H <host>] [-p <port>] [-u <path>] [-b <n>] [-d <ms>]
+  serve.py -h | --help
+
+Options:
+  -i <file>     Language model file.
+  -H <host>, --host <host>
+                Address to listen on [default: 127.0.0.1].
+  -p <port>, --port <port>
+                TCP port to listen on [default: 8000].
+  -u <path>, --unix <path>
+                Listen on this Unix socket instead of a TCP port.
+  -b <n>, --max-batch <n>
+                Number of sentences that closes a batch [default: 256].
+  -d <ms>, --max-delay <ms>
+                Milliseconds a batch waits for more requests [default: 2].
+  -h --help     Show this screen.
+"""
+from docopt import docopt
+
+import os.path
+import sys
+# Add ../../ to PYTHONPATH
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        os.pardir, os.pardir))
+
+from languagemodeling.ngram import NGram
+from languagemodeling.server import serve
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    # load the model, read-only while serving
+    model = NGram.load(opts['-i'])
+    model.freeze()
+
+    if opts['--unix']:
+        print('Serving on %s' % opts['--unix'], file=sys.stderr)
+    else:
+        print('Serving on http://%s:%s' % (opts['--host'], opts['--port']),
+              file=sys.stderr)
+    serve(model, opts['--host'], int(opts['--port']), opts['--unix'],
+          max_batch=int(opts['--max-batch']),
+          max_delay=float(opts['--max-delay']) / 1000.)
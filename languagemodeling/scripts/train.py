@@ -1,7 +1,9 @@
 """Train an n-gram model.
 
 Usage:
-  train.py -n <n> [-m <model>] -o <file>
+  train.py -n <n> [-m <model>] [-c <file>] [-j <jobs>] [-M <n>]
+           [-V <n>] [-U <n>] [--min-counts <counts>] [--prune <threshold>]
+           [-t <file>] -o <file>
   train.py -h | --help
 
 Options:
@@ -11,11 +13,30 @@ Options:
                   addone: N-grams with add-one smoothing.
                   interpolated: N-grams with linear interpolation
                   backoff: N-grams with Katz back-off
+  -c <file>     Corpus file with one tokenized sentence per line, or - for
+                the standard input (default: the Wikipedia training corpus).
+  -j <jobs>, --jobs <jobs>
+                Number of processes used for counting [default: 1].
+  -M <n>, --max-counts <n>
+                Number of distinct n-grams kept in memory while counting,
+                the rest are spilled to temporary files (default: no limit).
+  -V <n>, --max-vocab <n>
+                Number of most frequent tokens kept, the rest are counted as
+                <unk> (default: no limit).
+  -U <n>, --unk-count <n>
+                Tokens seen less than n times are counted as <unk>.
+  --min-counts <counts>
+                Comma separated minimum counts of the kept 2-grams, 3-grams,
+                etc. (only for backoff).
+  --prune <threshold>
+                Remove the n-grams whose removal increases the relative
+                entropy less than the threshold (only for backoff).
+  -t <file>     Test corpus file with one tokenized sentence per line, to
+                report the perplexity cost of pruning.
   -o <file>     Output model file.
   -h --help     Show this screen.
 """
 from docopt import docopt
-import pickle
 
 from nltk.corpus import PlaintextCorpusReader
 
@@ -31,31 +52,72 @@ from languagemodeling.ngram import NGram, AddOneNGram, \
     InterpolatedNGram, BackOffNGram
 
 
+def file_sents(f):
+    """Sentences of a file with one tokenized sentence per line."""
+    for line in f:
+        sent = line.split()
+        if sent:
+            yield sent
+
+
 if __name__ == '__main__':
     opts = docopt(__doc__)
 
-    corpus = PlaintextCorpusReader(
-        'corpus_wikipedia',
-        'spanishText_20000_25000_small'
-    )
-    sents = corpus.sents()
+    # the corpus is read in a single pass while training
+    corpus_file = opts['-c']
+    if corpus_file == '-':
+        sents = file_sents(sys.stdin)
+    elif corpus_file:
+        sents = file_sents(open(corpus_file))
+    else:
+        corpus = PlaintextCorpusReader(
+            'corpus_wikipedia',
+            'spanishText_20000_25000_small'
+        )
+        sents = corpus.sents()
 
     # train the model
     n = int(opts['-n'])
+    jobs = int(opts['--jobs'])
+    max_counts = opts['--max-counts'] and int(opts['--max-counts'])
     model_type = opts['-m'] or 'ngram'
     if model_type == 'ngram':
-        model = NGram(n, sents)
+        model = NGram(n, sents, jobs=jobs, max_counts=max_counts)
     elif model_type == 'addone':
-        model = AddOneNGram(n, sents)
+        model = AddOneNGram(n, sents, jobs=jobs, max_counts=max_counts)
     elif model_type == 'interpolated':
-        model = InterpolatedNGram(n, sents)
+        model = InterpolatedNGram(n, sents, jobs=jobs, max_counts=max_counts)
     elif model_type == 'backoff':
-        model = BackOffNGram(n, sents)
+        model = BackOffNGram(n, sents, jobs=jobs, max_counts=max_counts)
     else:
         print('Invalid model type')
         exit(1)
+
+    # prune it
+    max_vocab = opts['--max-vocab']
+    unk_count = opts['--unk-count']
+    min_counts = opts['--min-counts']
+    threshold = opts['--prune']
+    if (min_counts or threshold) and model_type != 'backoff':
+        print('Pruning is only available for backoff models')
+        exit(1)
+    test_sents = list(file_sents(open(opts['-t']))) if opts['-t'] else None
+    if test_sents is not None:
+        size = len(model.counts)
+        perplexity = model.perplexity(test_sents)
+    if max_vocab or unk_count:
+        model.restrict_vocab(max_vocab and int(max_vocab),
+                             unk_count and int(unk_count), max_counts)
+    if min_counts or threshold:
+        min_counts = min_counts and {
+            order: int(c) for order, c in enumerate(min_counts.split(','), 2)}
+        model.prune(min_counts, threshold and float(threshold))
+    if test_sents is not None:
+        sys.stderr.write('Entries: %d -> %d (%.1fx smaller)\n' % (
+            size, len(model.counts), size / max(len(model.counts), 1)))
+        sys.stderr.write('Perplexity: %g -> %g\n' % (
+            perplexity, model.perplexity(test_sents)))
+    if model_type == 'backoff':
+        model.finalize()
     # save it
-    filename = opts['-o']
-    f = open(filename, 'wb')
-    pickle.dump(model, f, protocol=2)
-    f.close()
+    model.save(opts['-o'])
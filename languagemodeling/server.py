@@ -0,0 +1,306 @@
+"""Scoring server for n-gram models, over HTTP on a TCP or Unix socket.
+
+The model is loaded once and the concurrent requests are coalesced into
+micro-batches for NGram.score_sents, which scores each distinct n-gram only
+once per batch. Scoring runs in a worker thread, one batch at a time, while
+the event loop keeps reading requests.
+
+Endpoints:
+
+    POST /score    body {"sents": [...]}, each sentence a list of tokens or a
+                   string of tokens separated by whitespace. Returns the
+                   log-probabilities of the tokens of each sentence (</s>
+                   included), of each sentence, and the total log-probability,
+                   cross entropy and perplexity of the request.
+    GET /metrics   counters, throughput and latency percentiles.
+
+Log-probabilities of impossible events are -Infinity, as written by json.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+from languagemodeling.ngram import Scores
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+class Metrics(object):
+    """Counters of a ScoringServer, with the latencies of the last requests.
+    """
+
+    def __init__(self, window=10000):
+        """
+        window -- number of latest requests used for the latency statistics.
+        """
+        self.start = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.sents = 0
+        self.tokens = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=window)
+
+    def record_batch(self, requests, sents, tokens):
+        self.batches += 1
+        self.requests += requests
+        self.sents += sents
+        self.tokens += tokens
+
+    def snapshot(self):
+        """Dict with the current values of the metrics.
+        """
+        uptime = time.monotonic() - self.start
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.
+            i = min(len(latencies) - 1, int(p / 100. * len(latencies)))
+            return latencies[i] * 1000.
+
+        return {
+            'uptime': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'sentences': self.sents,
+            'tokens': self.tokens,
+            'batches': self.batches,
+            'mean_batch_size': (float(self.sents) / self.batches
+                                if self.batches else 0.),
+            'sentences_per_second': self.sents / uptime if uptime else 0.,
+            'tokens_per_second': self.tokens / uptime if uptime else 0.,
+            'latency_ms': {
+                'mean': 1000. * sum(latencies) / len(latencies)
+                if latencies else 0.,
+                'p50': percentile(50),
+                'p90': percentile(90),
+                'p99': percentile(99),
+                'max': latencies[-1] * 1000. if latencies else 0.,
+            },
+        }
+
+
+def _request_scores(token_log_probs, sent_log_probs, base):
+    """Scores of the sentences of a single request.
+    """
+    logp = sum(sent_log_probs)
+    size = sum(len(log_probs) for log_probs in token_log_probs)
+    crosse = -logp / size if size else float('nan')
+    return Scores(token_log_probs, sent_log_probs, logp, crosse,
+                  base ** crosse)
+
+
+class ScoringServer(object):
+
+    def __init__(self, model, max_batch=256, max_delay=0.002, base=2.):
+        """
+        model -- n-gram model. It must not change while serving, see
+            NGram.freeze().
+        max_batch -- number of sentences that closes a batch (a single
+            request may exceed it).
+        max_delay -- seconds a batch waits for more requests, after the
+            first one.
+        base -- base of the logarithms.
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.base = base
+        self.metrics = Metrics()
+        self.executor = ThreadPoolExecutor(1)
+        self.queue = None
+        self.batcher = None
+        # requests of the batch being gathered or scored
+        self.batch = []
+
+    def _start_batcher(self):
+        if self.batcher is None:
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.ensure_future(self._run_batches())
+
+    async def score(self, sents):
+        """Score the sentences of a request, in the next batch.
+
+        sents -- list of sentences, each one being a list of tokens.
+
+        Returns a Scores tuple.
+        """
+        self._start_batcher()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sents, future, time.monotonic()))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        queue = self.queue
+        while True:
+            batch = self.batch = [await queue.get()]
+            size = len(batch[0][0])
+            if size < self.max_batch and self.max_delay:
+                await asyncio.sleep(self.max_delay)
+            while size < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+                size += len(batch[-1][0])
+
+            sents = [sent for request, _, _ in batch for sent in request]
+            try:
+                scores = await loop.run_in_executor(
+                    self.executor, self.model.score_sents, sents, self.base)
+            except Exception as e:
+                self.metrics.errors += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self.batch = []
+                continue
+
+            tokens = sum(len(log_probs)
+                         for log_probs in scores.token_log_probs)
+            self.metrics.record_batch(len(batch), len(sents), tokens)
+            end = time.monotonic()
+            i = 0
+            for request, future, start in batch:
+                j = i + len(request)
+                self.metrics.latencies.append(end - start)
+                if not future.done():
+                    future.set_result(_request_scores(
+                        scores.token_log_probs[i:j],
+                        scores.sent_log_probs[i:j], self.base))
+                i = j
+            self.batch = []
+
+    async def _route(self, method, path, body):
+        """Status and JSON serializable result of an HTTP request.
+        """
+        if path == '/metrics':
+            if method != 'GET':
+                return 405, {'error': 'Use GET'}
+            return 200, self.metrics.snapshot()
+        if path != '/score':
+            return 404, {'error': 'Unknown path %s' % path}
+        if method != 'POST':
+            return 405, {'error': 'Use POST'}
+
+        try:
+            sents = json.loads(body.decode('utf-8'))['sents']
+            sents = [sent.split() if isinstance(sent, str) else list(sent)
+                     for sent in sents]
+            if not all(isinstance(t, str) for sent in sents for t in sent):
+                raise ValueError('Tokens must be strings')
+        except (ValueError, KeyError, TypeError) as e:
+            self.metrics.errors += 1
+            return 400, {'error': 'Bad request: %s' % e}
+        try:
+            scores = await self.score(sents)
+        except Exception as e:
+            return 500, {'error': str(e)}
+        return 200, scores._asdict()
+
+    async def handle(self, reader, writer):
+        """Serve the HTTP requests of a connection, keeping it alive unless
+        the client asks to close it.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if not header.strip():
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                fields = line.decode('latin-1').split()
+                try:
+                    method, path = fields[0], fields[1]
+                    length = int(headers.get('content-length', 0))
+                except (IndexError, ValueError):
+                    self._respond(writer, 400, {'error': 'Bad request'}, True)
+                    break
+                body = await reader.readexactly(length)
+                status, result = await self._route(method, path, body)
+                close = headers.get('connection', '').lower() == 'close'
+                self._respond(writer, status, result, close)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, result, close):
+        data = json.dumps(result).encode('utf-8')
+        head = 'HTTP/1.1 %d %s\r\n' % (status, REASONS[status])
+        head += 'Content-Type: application/json\r\n'
+        head += 'Content-Length: %d\r\n' % len(data)
+        if close:
+            head += 'Connection: close\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + data)
+
+    async def start(self, host='127.0.0.1', port=8000, path=None):
+        """Start listening, on a Unix socket if a path is given, else on a
+        TCP port (0 for any free one).
+
+        Returns the asyncio Server.
+        """
+        self._start_batcher()
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def close(self):
+        """Stop the batches. The requests waiting in the queue or being
+        scored fail with a RuntimeError.
+        """
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+            self.batcher = None
+            pending = self.batch
+            while not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            self.batch = []
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(
+                        RuntimeError('The scoring server is closed'))
+        self.executor.shutdown()
+
+
+def serve(model, host='127.0.0.1', port=8000, path=None, **kwargs):
+    """Serve a model until interrupted.
+
+    model -- n-gram model.
+    host, port -- TCP address to listen on.
+    path -- if given, listen on this Unix socket instead.
+    kwargs -- options of ScoringServer.
+    """
+    server = ScoringServer(model, **kwargs)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listener = loop.run_until_complete(server.start(host, port, path))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        loop.run_until_complete(server.close())
+        loop.close()
@@ -0,0 +1,186 @@
+"""Binary model files that can be opened with mmap.
+
+Layout of a file (all integers unsigned, in the byte order of the machine that
+wrote it, as recorded in the index):
+
+    magic (8 bytes) | version (4) | reserved (4) | index offset (8)
+    sections, each one aligned to 8 bytes
+    index: a JSON object describing the model and the sections
+
+The sections are the vocabulary (tokens encoded in UTF-8 separated by NUL
+bytes) and, for each count table and order, the sorted packed keys and the
+values (counts, or numbers of the array typecode recorded in the index). Keys
+that fit in 64 bits are stored as native integers, wider keys as fixed-width
+big-endian byte strings, so both compare like the packed keys.
+Loading maps the file and reads the arrays in place, so processes opening
+the same file share it through the page cache.
+"""
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from languagemodeling.counts import Vocabulary, CountTable
+
+MAGIC = b'NGRAMLM\0'
+VERSION = 1
+PREAMBLE = struct.Struct('=8sIIQ')
+
+
+class WideKeys(object):
+    """Read-only sequence of packed keys stored as big-endian byte strings.
+    """
+
+    def __init__(self, buf, width):
+        """
+        buf -- buffer with the keys.
+        width -- size of each key in bytes.
+        """
+        self.buf = buf
+        self.width = width
+
+    def __len__(self):
+        return len(self.buf) // self.width
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        w = self.width
+        return int.from_bytes(self.buf[i * w: (i + 1) * w], 'big')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _align(f):
+    padding = -f.tell() % 8
+    f.write(b'\0' * padding)
+
+
+def _write_section(f, data):
+    """Write bytes aligned to 8 bytes and return [offset, size]."""
+    _align(f)
+    offset = f.tell()
+    f.write(data)
+    return [offset, len(data)]
+
+
+def save_model(filename, class_name, params, vocab, tables):
+    """Write a model file.
+
+    filename -- name of the file.
+    class_name -- name of the model class.
+    params -- dict of JSON serializable parameters.
+    vocab -- the Vocabulary.
+    tables -- dict from names to CountTables over vocab.
+
+    The file is written under a temporary name in the same directory and
+    then renamed, so a model mapped from the file being replaced is not
+    read while it is rewritten, and the file is never left half written.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                   prefix='.tmp-')
+    try:
+        # the permissions of a file created by open()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+        with os.fdopen(fd, 'wb') as f:
+            _write_model(f, class_name, params, vocab, tables)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def _write_model(f, class_name, params, vocab, tables):
+    """Write a model to an open file, see save_model."""
+    f.write(PREAMBLE.pack(MAGIC, VERSION, 0, 0))
+    vocab_data = '\0'.join(vocab.tokens).encode('utf-8')
+    index = {
+        'class': class_name,
+        'params': params,
+        'byteorder': sys.byteorder,
+        'vocab': _write_section(f, vocab_data),
+        'tables': {},
+    }
+    for name, table in tables.items():
+        orders = {}
+        for order in table.orders():
+            keys = table.keys[order]
+            width = (order * table.bits + 7) // 8
+            if order * table.bits <= 64:
+                width = 0
+                key_data = array('Q', keys).tobytes()
+            else:
+                key_data = b''.join(k.to_bytes(width, 'big') for k in keys)
+            values = array(table.typecode, table.values[order]).tobytes()
+            orders[str(order)] = {
+                'keys': _write_section(f, key_data),
+                'width': width,
+                'values': _write_section(f, values),
+            }
+        index['tables'][name] = {
+            'bits': table.bits,
+            'typecode': table.typecode,
+            'orders': orders,
+        }
+    _align(f)
+    index_offset = f.tell()
+    f.write(json.dumps(index).encode('utf-8'))
+    f.seek(0)
+    f.write(PREAMBLE.pack(MAGIC, VERSION, 0, index_offset))
+
+
+def load_model(filename):
+    """Open a model file.
+
+    filename -- name of the file.
+
+    Returns the class name, the params, the Vocabulary and the dict of
+    CountTables, whose arrays are views of the mapped file.
+    """
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    magic, version, _, index_offset = PREAMBLE.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError('%s is not a model file' % filename)
+    if version != VERSION:
+        raise ValueError('Unsupported model file version: %d' % version)
+    index = json.loads(bytes(buf[index_offset:]).decode('utf-8'))
+    swap = index['byteorder'] != sys.byteorder
+
+    def section(offset_size):
+        offset, size = offset_size
+        return buf[offset: offset + size]
+
+    def numbers(offset_size, typecode='Q'):
+        if swap:
+            result = array(typecode, section(offset_size).tobytes())
+            result.byteswap()
+            return result
+        return section(offset_size).cast(typecode)
+
+    vocab_data = bytes(section(index['vocab'])).decode('utf-8')
+    vocab = Vocabulary(vocab_data.split('\0') if vocab_data else [])
+    tables = {}
+    for name, table_index in index['tables'].items():
+        table = CountTable(vocab, typecode=table_index['typecode'])
+        table.bits = table_index['bits']
+        for order, order_index in table_index['orders'].items():
+            order = int(order)
+            if order_index['width']:
+                table.keys[order] = WideKeys(section(order_index['keys']),
+                                             order_index['width'])
+            else:
+                table.keys[order] = numbers(order_index['keys'])
+            table.values[order] = numbers(order_index['values'],
+                                          table.typecode)
+        tables[name] = table
+
+    return index['class'], index['params'], vocab, tables
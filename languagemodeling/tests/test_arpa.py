@@ -0,0 +1,102 @@
+# https://docs.python.org/3/library/unittest.html
+from unittest import TestCase
+from io import StringIO
+from math import log10
+import os.path
+import tempfile
+
+from languagemodeling.ngram import NGram, InterpolatedNGram, BackOffNGram, \
+    ArpaNGram
+from languagemodeling.arpa import write_arpa
+
+
+class TestArpa(TestCase):
+
+    def setUp(self):
+        self.sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+        ]
+        self.tokens = ['el', 'gato', 'come', 'pescado', '.', 'la', 'gata',
+                       'salmón', '</s>']
+        self.prevs = [['<s>', '<s>'], ['<s>', 'el'], ['el', 'gato'],
+                      ['gato', 'come'], ['come', 'come'], ['la', 'el'],
+                      ['salame', 'come'], ['salame', 'salame']]
+
+    def test_write(self):
+        model = BackOffNGram(2, self.sents, beta=0.5, addone=False)
+        f = StringIO()
+        write_arpa(model, f)
+        lines = f.getvalue().split('\n')
+
+        self.assertEqual(lines[:4], ['\\data\\', 'ngram 1=10', 'ngram 2=11',
+                                     ''])
+        self.assertIn('%.7g\tcome\t%.7g' % (
+            log10(2 / 12.0), log10(model.backoff_weight(('come',)))), lines)
+        self.assertIn('%.7g\tcome pescado' % log10(0.5 / 2), lines)
+        self.assertEqual(lines[-2:], ['\\end\\', ''])
+
+    def test_round_trip(self):
+        models = [
+            BackOffNGram(3, self.sents, beta=0.5),
+            BackOffNGram(3, self.sents, beta=0.5, addone=False),
+            InterpolatedNGram(3, self.sents, gamma=1.0),
+            InterpolatedNGram(3, self.sents, gamma=2.0, addone=False),
+        ]
+        for model in models:
+            f = StringIO()
+            write_arpa(model, f)
+            f.seek(0)
+            arpa_model = ArpaNGram(f)
+
+            self.assertEqual(arpa_model.n, 3)
+            self.assertEqual(arpa_model.V(), model.V())
+            for prev in self.prevs:
+                for token in self.tokens:
+                    # 7 significant digits in the file
+                    self.assertAlmostEqual(arpa_model.cond_prob(token, prev),
+                                           model.cond_prob(token, prev), 6,
+                                           msg=(token, prev))
+
+    def test_unk(self):
+        f = StringIO('\n'.join([
+            '\\data\\', 'ngram 1=3', 'ngram 2=1', '',
+            '\\1-grams:', '-1\t<unk>', '-0.5\tla\t-0.2', '-0.3\t</s>', '',
+            '\\2-grams:', '-0.1\tla </s>', '', '\\end\\', ''
+        ]))
+        model = ArpaNGram(f)
+
+        self.assertAlmostEqual(model.cond_prob('perro'), 0.1)
+        self.assertAlmostEqual(model.cond_prob('</s>', ['la']), 10 ** -0.1)
+        self.assertAlmostEqual(model.cond_prob('perro', ['la']),
+                               10 ** (-0.2 - 1))
+        self.assertAlmostEqual(model.cond_prob('la', ['perro', 'la']),
+                               10 ** (-0.2 - 0.5))
+
+    def test_save_load(self):
+        f = StringIO()
+        write_arpa(BackOffNGram(2, self.sents, beta=0.5), f)
+        f.seek(0)
+        model = ArpaNGram(f)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'model.lm')
+            model.save(filename)
+            loaded = NGram.load(filename)
+
+            for token in self.tokens:
+                self.assertEqual(loaded.cond_prob(token, ['come']),
+                                 model.cond_prob(token, ['come']))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            ArpaNGram(StringIO('\\data\\\nngram 1=2\n\n\\1-grams:\n-1\ta\n'
+                               '\\end\\\n'))
+
+    def test_merge(self):
+        f = StringIO()
+        write_arpa(BackOffNGram(2, self.sents, beta=0.5), f)
+        f.seek(0)
+        model = ArpaNGram(f)
+
+        with self.assertRaises(ValueError):
+            NGram.merge([model, model])
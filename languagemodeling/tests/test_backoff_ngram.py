@@ -248,5 +248,263 @@ class TestBackoffNGram(TestCase):
         for gram, c in counts.items():
             self.assertEqual(model.count(gram), c, gram)
 
+    def test_held_out_generator(self):
+        # a one-shot generator is consumed in a single pass
+        model = BackOffNGram(2, (sent for sent in self.sents))
+        model2 = BackOffNGram(2, self.sents)
+
+        self.assertEqual(dict(model.counts.items()), dict(model2.counts.items()))
+        self.assertEqual(model.count(('la',)), 0)
+        # held-out tokens are still part of the vocabulary
+        self.assertEqual(model.V(), 9)
+        self.assertEqual(model.beta, model2.beta)
+
+    def test_parallel(self):
+        sents = self.sents * 10
+        model = BackOffNGram(3, sents, jobs=2)
+        model2 = BackOffNGram(3, sents)
+
+        self.assertEqual(dict(model.counts.items()), dict(model2.counts.items()))
+        self.assertEqual(dict(model.sum_c.items()), dict(model2.sum_c.items()))
+        self.assertEqual(model.V(), model2.V())
+        self.assertEqual(model.beta, model2.beta)
+
+    def test_finalize(self):
+        tokens = ['el', 'gato', 'come', 'pescado', '.', 'la', 'gata', 'salmón',
+                  '</s>', 'salame']
+        prevs = [['<s>', '<s>'], ['<s>', 'el'], ['el', 'gato'], ['come', 'come'],
+                 ['salame', 'come'], ['salame', 'salame']]
+
+        for addone in [True, False]:
+            model = BackOffNGram(3, self.sents, beta=0.5, addone=addone)
+            probs = {(t, tuple(p)): model.cond_prob(t, p)
+                     for t in tokens for p in prevs}
+            alphas = {tuple(p): model.alpha(tuple(p)) for p in prevs}
+            model.finalize()
+
+            # one for each seen unigram and bigram
+            self.assertEqual(len(model.alphas), 10 + 12)
+            for (token, prev), p in probs.items():
+                self.assertEqual(model.cond_prob(token, prev), p)
+            for prev, a in alphas.items():
+                self.assertEqual(model.alpha(prev), a)
+
+    def test_tune_beta(self):
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el gato come salmón .'.split(),
+            'la gata come pescado .'.split(),
+            'el perro come carne .'.split(),
+            'la gata duerme .'.split(),
+        ] * 3
+        model = BackOffNGram(3, sents)
+        heldout = sents[1::10]
+        best = model.perplexity(heldout)
+
+        # at least as good as every candidate of the grid
+        for beta in BackOffNGram.BETA_CANDIDATES:
+            model.beta = beta
+            self.assertAlmostLessEqual(best, model.perplexity(heldout))
+
+            # the held-out statistics give the same probabilities
+            for sent in heldout:
+                prev = ('<s>', '<s>')
+                for token in sent + ['</s>']:
+                    key, known = model._context_key(prev)
+                    stats = model._event_stats(key, known,
+                                               model.vocab.ids.get(token, -1))
+                    self.assertEqual(model._stats_prob(stats),
+                                     model.cond_prob(token, prev))
+                    prev = (prev + (token,))[1:]
+
+    def test_update(self):
+        sents = self.sents + [
+            'el perro come carne .'.split(),
+            'la gata duerme .'.split(),
+        ]
+        for addone in [True, False]:
+            model = BackOffNGram(3, sents, beta=0.5, addone=addone)
+            model.finalize()
+            updated = BackOffNGram(3, sents[:1], beta=0.5, addone=addone)
+            updated.finalize()
+            updated.update(sents[1:])
+
+            self.assertEqual(updated.V(), model.V())
+            for name in ['counts', 'card_a', 'sum_c', 'alphas', 'denoms']:
+                self.assertEqual(dict(getattr(updated, name).items()),
+                                 dict(getattr(model, name).items()))
+            prev = ('gata', 'come')
+            for token in ['salmón', 'pescado', 'carne', 'duerme', '</s>']:
+                self.assertEqual(updated.cond_prob(token, prev),
+                                 model.cond_prob(token, prev))
+
+    def test_merge(self):
+        sents = self.sents + [
+            'el perro come carne .'.split(),
+            'la gata duerme .'.split(),
+        ]
+        model = BackOffNGram(3, sents, beta=0.5)
+        model1 = BackOffNGram(3, sents[:2], beta=0.5)
+        model2 = BackOffNGram(3, sents[2:], beta=0.5)
+        merged = BackOffNGram.merge([model1, model2])
+
+        self.assertEqual(merged.vocab.tokens, model.vocab.tokens)
+        self.assertEqual(merged.V(), model.V())
+        for name in ['counts', 'card_a', 'sum_c']:
+            self.assertEqual(dict(getattr(merged, name).items()),
+                             dict(getattr(model, name).items()))
+
+        # subtracting gives back the counts of the first model, but the
+        # vocabulary is kept
+        merged = BackOffNGram.merge([model, model2], weights=[1, -1])
+        for name in ['counts', 'card_a', 'sum_c']:
+            self.assertEqual(dict(getattr(merged, name).items()),
+                             dict(getattr(model1, name).items()))
+        self.assertEqual(merged.V(), model.V())
+
+    def test_merge_fractional(self):
+        sents = self.sents + ['el perro come carne .'.split()]
+        model = BackOffNGram(3, sents, beta=0.5)
+        model1 = BackOffNGram(3, sents[:2], beta=0.5)
+        model2 = BackOffNGram(3, sents[2:], beta=0.5)
+        # halving the counts of both models halves those of the whole corpus
+        merged = BackOffNGram.merge([model1, model2], weights=[0.5, 0.5])
+
+        self.assertEqual(merged.counts.typecode, 'd')
+        for name in ['counts', 'sum_c']:
+            self.assertEqual(dict(getattr(merged, name).items()),
+                             {k: v / 2. for k, v
+                              in getattr(model, name).items()})
+        self.assertEqual(dict(merged.card_a.items()),
+                         dict(model.card_a.items()))
+
+        # the back-off weights of the fractional counts
+        prev_tokens = ('el', 'gato')
+        probs = [merged.cond_prob(token, prev_tokens)
+                 for token in ['come', 'pescado', '.', 'salame']]
+        merged.finalize()
+        for token, prob in zip(['come', 'pescado', '.', 'salame'], probs):
+            self.assertAlmostEqual(merged.cond_prob(token, prev_tokens),
+                                   prob)
+
+    def test_prune(self):
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el gato come salmón .'.split(),
+            'el perro come carne .'.split(),
+            'la gata duerme .'.split(),
+        ] * 2 + [
+            'el perro duerme .'.split(),
+        ]
+        tokens = ['el', 'gato', 'come', 'pescado', '.', 'la', 'gata',
+                  'salmón', 'perro', 'carne', 'duerme', '</s>']
+        prevs = [('<s>', '<s>'), ('<s>', 'el'), ('el', 'perro'),
+                 ('perro', 'duerme'), ('gata', 'come'), ('come', 'carne')]
+
+        for addone in [True, False]:
+            for min_counts, threshold in [({2: 2}, None), ({3: 3}, None),
+                                          (None, 0.01), ({3: 2}, 0.001)]:
+                model = BackOffNGram(3, sents, beta=0.5, addone=addone)
+                size = len(model.counts)
+                removed = model.prune(min_counts, threshold)
+
+                self.assertTrue(removed > 0)
+                self.assertEqual(len(model.counts), size - removed)
+                self.assertNotIn(('el', 'perro', 'duerme'), model.counts)
+                # the back-off weights account for the pruned n-grams
+                for prev in prevs:
+                    prob_sum = sum(model.cond_prob(token, prev)
+                                   for token in tokens)
+                    self.assertAlmostEqual(prob_sum, 1.0, msg=prev)
+                self.assertTrue(model.perplexity(sents) < float('inf'))
+
+                # the same with the precomputed tables
+                model.finalize()
+                for prev in prevs:
+                    prob_sum = sum(model.cond_prob(token, prev)
+                                   for token in tokens)
+                    self.assertAlmostEqual(prob_sum, 1.0, msg=prev)
+
+        # a higher threshold removes more n-grams
+        removed = [BackOffNGram(3, sents, beta=0.5).prune(threshold=t)
+                   for t in [0.001, 0.01, 0.1]]
+        self.assertEqual(sorted(removed), removed)
+
+    def test_restrict_vocab(self):
+        sents = self.sents + [
+            'el perro come carne .'.split(),
+            'el gato come salmón .'.split(),
+        ]
+        unk_sents = [
+            'el gato come <unk> .'.split(),
+            '<unk> <unk> come salmón .'.split(),
+            'el <unk> come <unk> .'.split(),
+            'el gato come salmón .'.split(),
+        ]
+        model = BackOffNGram(3, sents, beta=0.5)
+        model.finalize()
+        model.restrict_vocab(5)
+        unk_model = BackOffNGram(3, unk_sents, beta=0.5)
+
+        self.assertEqual(set(model.vocab.tokens), set(unk_model.vocab.tokens))
+        self.assertEqual(model.V(), 7)
+        for name in ['counts', 'card_a', 'sum_c']:
+            self.assertEqual(dict(getattr(model, name).items()),
+                             dict(getattr(unk_model, name).items()))
+        self.assertEqual(model.cond_prob('<unk>', ('gato', 'come')),
+                         unk_model.cond_prob('<unk>', ('gato', 'come')))
+
     def assertAlmostLessEqual(self, a, b, places=7, msg=None):
         self.assertTrue(a < b or round(abs(a - b), places) == 0, msg=msg)
+
+    def test_score(self):
+        models = [
+            BackOffNGram(3, self.sents, beta=0.5),
+            BackOffNGram(3, self.sents, beta=0.5, addone=False),
+            BackOffNGram(3, self.sents, beta=0.),
+        ]
+        models[1].finalize()
+        models[2].prune(min_counts={2: 2})
+        sent = 'el gato come salame salmón .'.split()
+
+        for model in models:
+            state = model.begin_sentence()
+            prev_tokens = ('<s>', '<s>')
+            for token in sent + ['</s>']:
+                prob, state = model._advance(state, token)
+                self.assertEqual(prob, model.cond_prob(token, prev_tokens))
+                prev_tokens = (prev_tokens + (token,))[1:]
+
+    def test_freeze(self):
+        model = BackOffNGram(3, self.sents, beta=0.5)
+        prob = model.cond_prob('come', ('el', 'gato'))
+        model.freeze()
+
+        self.assertIsNotNone(model.alphas)
+        self.assertEqual(model.cond_prob('come', ('el', 'gato')), prob)
+        with self.assertRaises(AttributeError):
+            model.beta = 0.2
+        with self.assertRaises(AttributeError):
+            model.prune(min_counts={2: 2})
+        self.assertEqual(model.beta, 0.5)
+
+        # reads build nothing once frozen
+        model = BackOffNGram(3, self.sents, beta=0.5)
+        model.freeze()
+        tables = [getattr(model, name) for name in model.TABLES]
+        state = [(dict(table.index), table._indexes)
+                 for table in tables if table is not None]
+        self.assertEqual(model.cond_prob('come', ('el', 'gato')), prob)
+        model.sent_log_prob('la gata come pescado .'.split())
+        self.assertEqual([(dict(table.index), table._indexes)
+                          for table in tables if table is not None], state)
+
+    def test_cache(self):
+        model = BackOffNGram(3, self.sents, beta=0.5)
+        model.freeze()
+        model.enable_cache()
+        prob = model.cond_prob('salmón', ('gato', 'come'))
+        self.assertEqual(model.cond_prob('salmón', ['gato', 'come']), prob)
+        self.assertEqual(model.cache_info()['_key_prob'].hits, 1)
@@ -0,0 +1,249 @@
+# https://docs.python.org/3/library/unittest.html
+from unittest import TestCase
+import os
+from tempfile import TemporaryDirectory
+
+from languagemodeling.counts import Vocabulary, CountTable, SortedRuns, \
+    PackedCounts, count_sents, parallel_count_sents, combine_tables
+
+
+class TestCountTable(TestCase):
+
+    def setUp(self):
+        self.vocab = Vocabulary(['<s>', '</s>', 'el', 'gato', 'la', 'gata'])
+        encode = self.vocab.encode
+        self.counts = {
+            (): 6,
+            encode(['el']): 1,
+            encode(['gato']): 2,
+            encode(['el', 'gato']): 1,
+            encode(['la', 'gato']): 1,
+            encode(['el', 'gata']): 3,
+        }
+
+    def test_vocabulary(self):
+        self.assertEqual(len(self.vocab), 6)
+        self.assertEqual(self.vocab.add('gato'), 3)
+        self.assertEqual(self.vocab.encode(['la', 'gata']), (4, 5))
+        self.assertEqual(self.vocab.encode(['la', 'perro']), None)
+        self.assertEqual(self.vocab.decode((2, 3)), ('el', 'gato'))
+
+    def test_count(self):
+        table = CountTable(self.vocab, self.counts)
+
+        counts = {
+            (): 6,
+            ('el',): 1,
+            ('gato',): 2,
+            ('la',): 0,
+            ('perro',): 0,
+            ('el', 'gato'): 1,
+            ('el', 'gata'): 3,
+            ('gato', 'el'): 0,
+            ('el', 'gato', 'la'): 0,
+        }
+        for gram, c in counts.items():
+            self.assertEqual(table[gram], c, gram)
+        self.assertEqual(len(table), 6)
+        self.assertEqual(set(table), {self.vocab.decode(k) for k in self.counts})
+
+    def test_successors(self):
+        table = CountTable(self.vocab, self.counts)
+        encode = self.vocab.encode
+
+        succ = dict(table.successors(encode(['el'])))
+        self.assertEqual(succ, {3: 1, 5: 3})
+        self.assertEqual(dict(table.successors(encode(['gata']))), {})
+        self.assertEqual(dict(table.successors(())), {2: 1, 3: 2})
+
+    def test_suffix_counts(self):
+        table = CountTable(self.vocab, self.counts)
+        encode = self.vocab.encode
+
+        key = table.pack(encode(['el', 'gato']))
+        self.assertEqual(table.suffix_counts(key, 2), [1, 2, 6])
+        key = table.pack(encode(['la', 'gata']))
+        self.assertEqual(table.suffix_counts(key, 2), [0, 0, 6])
+        self.assertEqual(table.successor_range(table.pack(encode(['el'])), 1),
+                         (0, 2))
+        self.assertEqual(table.successor_range(key, 2), (0, 0))
+
+    def test_index(self):
+        table = CountTable(self.vocab, self.counts)
+        keys = [table.pack(ids) for ids in self.counts] + [table.pack((5,))]
+        values = [self.counts.get(ids, 0) for ids in self.counts] + [0]
+
+        self.assertEqual(table.index, {})
+        self.assertEqual([table.get_key(k, 1) for k in keys[1:3]], [1, 2])
+        self.assertEqual(table.get_keys(keys, 1, -1)[1:3], [1, 2])
+        self.assertEqual(table.get_keys(keys[3:6], 2), values[3:6])
+        self.assertEqual(table.get_keys(keys[-1:], 1), [0])
+        # binary searches, no hash index of the table
+        self.assertEqual(set(table.index), {1})
+        self.assertFalse(any(isinstance(index, dict)
+                             for index in table.index.values()))
+        indexes = table.indexes(4)
+        self.assertEqual([indexes[1].get(k, 0) for k in keys[1:3]], [1, 2])
+        self.assertEqual(table.get_keys(keys, 5), [0] * len(keys))
+
+    def test_packed_counts(self):
+        counts = PackedCounts(len(self.vocab))
+        for ids, count in self.counts.items():
+            counts.add(ids, count)
+        self.assertEqual(dict(counts), self.counts)
+
+        # a vocabulary that outgrows the bits of the ids
+        bits = counts.bits
+        self.assertTrue(counts.reserve(1 << (bits + 1)) > bits)
+        self.assertEqual(dict(counts), self.counts)
+        table = CountTable(self.vocab, counts)
+        self.assertEqual(dict(table.id_items()), self.counts)
+
+        # with 'la' and 'gata' swapped
+        other = PackedCounts()
+        other.merge(counts, [0, 1, 2, 3, 5, 4])
+        self.assertEqual(other[(5, 3)], 1)
+        self.assertEqual(other[(2, 4)], 3)
+        other.merge(counts)
+        self.assertEqual(other[(2, 3)], 2)
+        self.assertEqual(other[(2, 5)], 3)
+        self.assertEqual(other[()], 12)
+
+
+class TestCombineTables(TestCase):
+
+    def setUp(self):
+        self.sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el perro come carne .'.split(),
+        ]
+
+    def table(self, sents):
+        vocab = Vocabulary(['<s>', '</s>'])
+        counts, _ = count_sents(vocab, sents, 2, all_orders=True)
+        return CountTable(vocab, counts)
+
+    def test_sum(self):
+        table = self.table(self.sents)
+        # different vocabularies, with the ids in a different order
+        table1 = self.table(self.sents[2:])
+        table2 = self.table(self.sents[:2])
+
+        for max_counts in [None, 3]:
+            vocab = Vocabulary(table1.vocab.tokens)
+            result = combine_tables(vocab, [table1, table2],
+                                    max_counts=max_counts)
+            self.assertEqual(dict(result.items()), dict(table.items()))
+        self.assertEqual(dict((table1 + table2).items()), dict(table.items()))
+
+    def test_subtract_scale(self):
+        table = self.table(self.sents)
+        table1 = self.table(self.sents[:1])
+        table2 = self.table(self.sents[1:])
+
+        self.assertEqual(dict((table - table1).items()),
+                         dict(table2.items()))
+        with self.assertRaises(ValueError):
+            table1 - table
+
+        scaled = table1 * 1.5
+        self.assertEqual(scaled.typecode, 'd')
+        self.assertEqual(scaled[('el', 'gato')], 1.5)
+        self.assertEqual(dict((2 * table1).items()),
+                         dict((table1 + table1).items()))
+
+
+class TestParallelCount(TestCase):
+
+    def setUp(self):
+        self.sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el perro come carne .'.split(),
+        ] * 5
+
+    def test_same_as_serial(self):
+        for n in [1, 2, 3]:
+            for all_orders in [False, True]:
+                vocab = Vocabulary(['<s>', '</s>'])
+                counts, heldout = count_sents(vocab, self.sents, n,
+                                              all_orders, heldout=True)
+                vocab2 = Vocabulary(['<s>', '</s>'])
+                counts2, heldout2 = parallel_count_sents(
+                    vocab2, iter(self.sents), n, all_orders, heldout=True,
+                    jobs=2, shard_size=4)
+
+                self.assertEqual(vocab2.tokens, vocab.tokens)
+                self.assertEqual(dict(counts2), dict(counts))
+                self.assertEqual(heldout2, heldout)
+
+    def test_known_tokens(self):
+        # the ids of the tokens already in the vocabulary are kept
+        vocab = Vocabulary(['<s>', '</s>', 'come', 'perro'])
+        counts, _ = count_sents(vocab, self.sents, 2)
+        vocab2 = Vocabulary(['<s>', '</s>', 'come', 'perro'])
+        counts2, _ = parallel_count_sents(vocab2, iter(self.sents), 2,
+                                          jobs=2, shard_size=4)
+
+        self.assertEqual(vocab2.tokens, vocab.tokens)
+        self.assertEqual(dict(counts2), dict(counts))
+
+    def test_unk(self):
+        tokens = ['<s>', '</s>', '<unk>', 'el', 'come', '.']
+        vocab = Vocabulary(tokens)
+        counts, heldout = count_sents(vocab, self.sents, 3, True,
+                                      heldout=True, unk='<unk>')
+        vocab2 = Vocabulary(tokens)
+        counts2, heldout2 = parallel_count_sents(
+            vocab2, iter(self.sents), 3, True, heldout=True, jobs=3,
+            shard_size=4, unk='<unk>')
+
+        self.assertEqual(vocab2.tokens, tokens)
+        self.assertEqual(dict(counts2), dict(counts))
+        self.assertEqual(heldout2, heldout)
+
+    def test_runs(self):
+        vocab = Vocabulary(['<s>', '</s>'])
+        counts, _ = count_sents(vocab, self.sents, 3, all_orders=True)
+        table = CountTable(vocab, counts)
+
+        vocab2 = Vocabulary(['<s>', '</s>'])
+        with TemporaryDirectory() as dir:
+            runs = SortedRuns(max_counts=10, dir=dir)
+            counts2, _ = parallel_count_sents(
+                vocab2, iter(self.sents), 3, all_orders=True, jobs=2,
+                shard_size=4, runs=runs)
+            self.assertTrue(len(runs.runs) > 1)
+            # the runs of the reducers are removed once adopted
+            self.assertEqual(os.listdir(dir), [])
+            table2 = CountTable.from_sorted(vocab2, runs.merge(counts2))
+
+        self.assertEqual(vocab2.tokens, vocab.tokens)
+        self.assertEqual(dict(table2.items()), dict(table.items()))
+
+
+class TestSortedRuns(TestCase):
+
+    def setUp(self):
+        self.sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el perro come carne .'.split(),
+        ] * 5
+
+    def test_same_as_in_memory(self):
+        for n in [1, 2, 3]:
+            vocab = Vocabulary(['<s>', '</s>'])
+            counts, _ = count_sents(vocab, self.sents, n, all_orders=True)
+            table = CountTable(vocab, counts)
+
+            vocab2 = Vocabulary(['<s>', '</s>'])
+            runs = SortedRuns(max_counts=5)
+            counts2, _ = count_sents(vocab2, self.sents, n, all_orders=True,
+                                     runs=runs)
+            self.assertTrue(len(runs.runs) > 1)
+            table2 = CountTable.from_sorted(vocab2, runs.merge(counts2))
+
+            self.assertEqual(dict(table2.items()), dict(table.items()))
+            self.assertEqual(table2.keys, table.keys)
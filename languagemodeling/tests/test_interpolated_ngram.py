@@ -178,5 +178,88 @@ class TestInterpolatedNGram(TestCase):
         for gram, c in counts.items():
             self.assertEqual(model.count(gram), c, gram)
 
+    def test_max_counts(self):
+        model = InterpolatedNGram(3, self.sents * 10, max_counts=8)
+        model2 = InterpolatedNGram(3, self.sents * 10)
+
+        self.assertEqual(dict(model.counts.items()), dict(model2.counts.items()))
+        self.assertEqual(model.gamma, model2.gamma)
+
+    def test_tune_gamma(self):
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el gato come salmón .'.split(),
+            'la gata come pescado .'.split(),
+            'el perro come carne .'.split(),
+            'la gata duerme .'.split(),
+        ] * 3
+        model = InterpolatedNGram(3, sents)
+        heldout = sents[1::10]
+        best = model.perplexity(heldout)
+
+        # at least as good as every candidate of the grid
+        for gamma in InterpolatedNGram.GAMMA_CANDIDATES:
+            model.gamma = gamma
+            self.assertAlmostLessEqual(best, model.perplexity(heldout))
+
+            # the held-out statistics give the same probabilities
+            for sent in heldout:
+                prev = ('<s>', '<s>')
+                for token in sent + ['</s>']:
+                    key, known = model._context_key(prev)
+                    stats = model._event_stats(key, known,
+                                               model.vocab.ids.get(token, -1))
+                    self.assertEqual(model._stats_prob(stats),
+                                     model.cond_prob(token, prev))
+                    prev = (prev + (token,))[1:]
+
+    def test_update(self):
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+            'el perro come carne .'.split(),
+        ] * 5
+        model = InterpolatedNGram(3, sents)
+        updated = InterpolatedNGram(3, sents[:7])
+        updated.update(sents[7:], retune=True)
+
+        # held out the same sentences
+        self.assertEqual(updated.train_size, len(sents))
+        self.assertEqual(dict(updated.counts.items()),
+                         dict(model.counts.items()))
+        updated.gamma = model.gamma
+        prev = ('come', 'pescado')
+        for token in ['.', 'el', 'carne', '</s>']:
+            self.assertEqual(updated.cond_prob(token, prev),
+                             model.cond_prob(token, prev))
+
     def assertAlmostLessEqual(self, a, b, places=7, msg=None):
         self.assertTrue(a < b or round(abs(a - b), places) == 0, msg=msg)
+
+    def test_cache(self):
+        model = InterpolatedNGram(3, self.sents, gamma=1.0)
+        model.enable_cache(maxsize=100)
+        sents = [
+            'el gato come salmón .'.split(),
+            'la gata come pescado .'.split(),
+        ]
+        log_probs = [model.sent_log_prob(sent) for sent in sents]
+        self.assertEqual([model.sent_log_prob(sent) for sent in sents],
+                         log_probs)
+        info = model.cache_info()
+        self.assertEqual(set(info), {'_key_prob'})
+        self.assertEqual(info['_key_prob'].hits, 12)
+
+        # the attributes that don't change the probabilities keep them
+        model.train_size += 1
+        self.assertTrue(model.cache_info()['_key_prob'].currsize > 0)
+
+        # changing gamma empties the caches
+        model.gamma = 10.0
+        self.assertEqual(model.cache_info()['_key_prob'].currsize, 0)
+        model.disable_cache()
+        self.assertEqual(model.cache_info(), {})
+        probs = [model.sent_log_prob(sent) for sent in sents]
+        model.enable_cache()
+        self.assertEqual([model.sent_log_prob(sent) for sent in sents], probs)
@@ -1,5 +1,6 @@
 # https://docs.python.org/3/library/unittest.html
 from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
 from math import log
 
 from languagemodeling.ngram import NGram
@@ -59,6 +60,13 @@ class TestNGram(TestCase):
         for gram, c in counts.items():
             self.assertEqual(ngram.count(gram), c)
 
+    def test_count_generator(self):
+        ngram = NGram(2, (sent for sent in self.sents))
+        ngram2 = NGram(2, self.sents)
+
+        self.assertEqual(dict(ngram.counts.items()), dict(ngram2.counts.items()))
+        self.assertEqual(ngram.V(), ngram2.V())
+
     def test_cond_prob_1gram(self):
         ngram = NGram(1, self.sents)
 
@@ -140,3 +148,153 @@ class TestNGram(TestCase):
         }
         for sent, prob in sents.items():
             self.assertAlmostEqual(ngram.sent_log_prob(sent.split()), prob, msg=sent)
+
+    def test_unk(self):
+        ngram = NGram(1, self.sents)
+        ngram.restrict_vocab(min_count=2)
+
+        # 'come', '.' and '</s>' have prob 1/6, the rest are <unk>
+        self.assertEqual(set(ngram.vocab.tokens),
+                         {'<s>', '</s>', 'come', '.', '<unk>'})
+        sent = 'el perro come salame .'.split()
+        self.assertEqual(ngram.map_unknown(sent),
+                         '<unk> <unk> come <unk> .'.split())
+        log_prob = 3 * log(0.5, 2) + 3 * log(1 / 6.0, 2)
+        self.assertAlmostEqual(ngram.sent_log_prob(sent), log_prob)
+        self.assertAlmostEqual(ngram.score_sents([sent]).log_prob, log_prob)
+
+    def test_update_unk(self):
+        sents = ['el perro come carne .'.split()] * 10
+        for jobs in [1, 2]:
+            ngram = NGram(2, self.sents)
+            ngram.restrict_vocab(min_count=2)
+            tokens = list(ngram.vocab.tokens)
+            count = ngram.counts[('<unk>', 'come')]
+            ngram.update(sents, jobs=jobs)
+
+            # the new tokens are counted as <unk>
+            self.assertEqual(ngram.vocab.tokens, tokens)
+            self.assertEqual(ngram.counts[('<unk>', 'come')], count + 10)
+
+    def test_unseen_context(self):
+        ngram = NGram(2, self.sents)
+
+        self.assertEqual(ngram.cond_prob('come', ('salame',)), 0.)
+        scores = ngram.score_sents(['el salame come'.split()])
+        self.assertEqual(scores.token_log_probs[0][2], float('-inf'))
+
+    def test_score_sents(self):
+        ngram = NGram(2, self.sents)
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come pescado .'.split(),
+            'el gato come salame .'.split(),
+            'la gata come salame .'.split(),
+        ]
+        scores = ngram.score_sents(iter(sents))
+
+        log2 = lambda x: log(x, 2)
+        self.assertEqual(scores.token_log_probs[0],
+                         [log2(0.5), 0., 0., log2(0.5), 0., 0.])
+        self.assertEqual(scores.token_log_probs[2][3], float('-inf'))
+        for sent, logp in zip(sents, scores.sent_log_probs):
+            self.assertEqual(logp, ngram.sent_log_prob(sent))
+        self.assertEqual(scores.log_prob, float('-inf'))
+        self.assertEqual(scores.perplexity, float('inf'))
+
+        scores = ngram.score_sents(sents[:2])
+        self.assertEqual(scores.log_prob, 4 * log2(0.5))
+        self.assertEqual(scores.cross_entropy, 4 / 12.)
+        self.assertEqual(scores.perplexity, 2 ** (4 / 12.))
+
+    def test_parallel_score_sents(self):
+        ngram = NGram(2, self.sents)
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come pescado .'.split(),
+            'el gato come salame .'.split(),
+        ] * 5
+        scores = ngram.score_sents(sents)
+        parallel_scores = ngram.parallel_score_sents(iter(sents), jobs=2,
+                                                     shard_size=2)
+
+        self.assertEqual(parallel_scores, scores)
+
+    def test_update(self):
+        sents = self.sents + [
+            'el perro come carne .'.split(),
+            'la gata come salame .'.split(),
+        ]
+        for n in [1, 2, 3]:
+            ngram = NGram(n, sents)
+            updated = NGram(n, sents[:1])
+            updated.update(sents[1:3])
+            updated.update(iter(sents[3:]), jobs=2, max_counts=4)
+
+            self.assertEqual(updated.vocab.tokens, ngram.vocab.tokens)
+            self.assertEqual(updated.V(), ngram.V())
+            self.assertEqual(dict(updated.counts.items()),
+                             dict(ngram.counts.items()))
+            self.assertEqual(updated.counts.keys, ngram.counts.keys)
+
+    def test_score(self):
+        for n in [1, 2, 3]:
+            ngram = NGram(n, self.sents)
+            sent = 'el gato come pescado .'.split()
+
+            state = ngram.begin_sentence()
+            prev_tokens = ('<s>',) * (n - 1)
+            log_prob = 0.
+            for token in sent + ['</s>']:
+                prob = ngram.cond_prob(token, prev_tokens)
+                logp, state = ngram.score(state, token)
+                self.assertAlmostEqual(logp, log(prob, 2))
+                log_prob += logp
+                prev_tokens = (prev_tokens + (token,))[1:]
+            self.assertAlmostEqual(log_prob, ngram.sent_log_prob(sent))
+
+        # the state after a token depends only on the last n-1 tokens
+        ngram = NGram(3, self.sents)
+        state1 = state2 = ngram.begin_sentence()
+        for token in 'el gato come'.split():
+            _, state1 = ngram.score(state1, token)
+        for token in 'la gata come'.split():
+            _, state2 = ngram.score(state2, token)
+        self.assertNotEqual(state1, state2)
+        _, state1 = ngram.score(state1, 'salmón')
+        _, state2 = ngram.score(state2, 'salmón')
+        self.assertEqual(state1, state2)
+
+    def test_freeze(self):
+        ngram = NGram(2, self.sents)
+        sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salame .'.split(),
+        ] * 10
+        scores = [ngram.sent_log_prob(sent) for sent in sents]
+        ngram.freeze()
+
+        with self.assertRaises(AttributeError):
+            ngram.update(['el perro come carne .'.split()])
+        with self.assertRaises(AttributeError):
+            ngram.restrict_vocab(min_count=2)
+        self.assertEqual(len(ngram.vocab), 10)
+        self.assertEqual(ngram.count(('perro',)), 0)
+
+        with ThreadPoolExecutor(4) as executor:
+            self.assertEqual(list(executor.map(ngram.sent_log_prob, sents)),
+                             scores)
+
+    def test_freeze_reads_only(self):
+        ngram = NGram(3, self.sents)
+        ngram.freeze()
+        # the indexes and the scoring function are built by freeze()
+        state = (dict(ngram.__dict__), dict(ngram.counts.index),
+                 ngram.counts._indexes)
+        self.assertIn('_key_probs_function', state[0])
+
+        ngram.sent_log_prob('el gato come salmón .'.split())
+        ngram.cond_prob('come', ('la', 'gata'))
+        self.assertEqual(ngram.count(('el', 'gato', 'come', 'pescado')), 0)
+        self.assertEqual((dict(ngram.__dict__), dict(ngram.counts.index),
+                          ngram.counts._indexes), state)
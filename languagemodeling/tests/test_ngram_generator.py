@@ -1,7 +1,8 @@
 # https://docs.python.org/3/library/unittest.html
 from unittest import TestCase
 
-from languagemodeling.ngram import NGram, NGramGenerator
+from languagemodeling.ngram import NGram, AddOneNGram, InterpolatedNGram, \
+    BackOffNGram, NGramGenerator
 
 
 class TestNGramGenerator(TestCase):
@@ -62,6 +63,19 @@ class TestNGramGenerator(TestCase):
         self.assertEqual(dict(generator.probs), probs)
         self.assertEqual(generator.sorted_probs, sorted_probs)
 
+    def test_probs_lazy(self):
+        ngram = NGram(2, self.sents)
+        generator = NGramGenerator(ngram)
+
+        probs = generator.probs
+        self.assertEqual(len(probs), 9)
+        self.assertEqual(generator.context_table.cache_info().currsize, 0)
+        self.assertEqual(probs[('come',)], {'pescado': 0.5, 'salmón': 0.5})
+        self.assertEqual(probs[('come',)], {'pescado': 0.5, 'salmón': 0.5})
+        self.assertNotIn(('perro',), probs)
+        info = generator.context_table.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+
     def test_generate_token(self):
         ngram = NGram(2, self.sents)
         generator = NGramGenerator(ngram)
@@ -75,6 +89,39 @@ class TestNGramGenerator(TestCase):
             token = generator.generate_token(('come',))
             self.assertTrue(token in ['pescado', 'salmón'])
 
+    def test_generate_token_distribution(self):
+        ngram = NGram(1, self.sents)
+        generator = NGramGenerator(ngram, seed=0)
+
+        self.assertAlmostEqual(sum(generator.probs[()].values()), 1.0)
+        counts = {}
+        for i in range(12000):
+            token = generator.generate_token()
+            counts[token] = counts.get(token, 0) + 1
+        for token, prob in generator.probs[()].items():
+            self.assertAlmostEqual(counts[token] / 12000., prob, 1)
+
+    def test_generate_token_smoothed(self):
+        models = [
+            AddOneNGram(2, self.sents),
+            InterpolatedNGram(2, self.sents, gamma=1.0),
+            InterpolatedNGram(3, self.sents, gamma=2.0, addone=False),
+            BackOffNGram(2, self.sents, beta=0.5),
+            BackOffNGram(3, self.sents, beta=0.5, addone=False),
+        ]
+        tokens = ['el', 'gato', 'come', 'pescado', '.', '</s>', 'la', 'gata',
+                  'salmón']
+        for ngram in models:
+            generator = NGramGenerator(ngram, seed=0)
+            prev_tokens = ('<s>',) * (ngram.n - 2) + ('come',)
+            counts = dict.fromkeys(tokens, 0)
+            for i in range(10000):
+                counts[generator.generate_token(prev_tokens)] += 1
+            for token in tokens:
+                prob = ngram.cond_prob(token, prev_tokens)
+                self.assertAlmostEqual(counts[token] / 10000., prob,
+                                       delta=0.02)
+
     def test_generate_sent_1gram(self):
         ngram = NGram(1, self.sents)
         generator = NGramGenerator(ngram)
@@ -100,3 +147,130 @@ class TestNGramGenerator(TestCase):
         for i in range(100):
             sent = generator.generate_sent()
             self.assertTrue(' '.join(sent) in sents, sent)
+
+    def test_cache(self):
+        ngram = NGram(2, self.sents)
+        generator = NGramGenerator(ngram, cache_size=2)
+
+        self.assertEqual(generator.cache_info().currsize, 0)
+        generator.generate_token(('el',))
+        generator.generate_token(('el',))
+        generator.generate_token(('come',))
+        generator.generate_token(('la',))
+        info = generator.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 3, 2))
+
+    def test_generate_sents(self):
+        ngram = BackOffNGram(2, self.sents, beta=0.5)
+        generator = NGramGenerator(ngram, seed=1)
+        sents = list(generator.generate_sents(25, batch_size=4))
+
+        self.assertEqual(len(sents), 25)
+        # the same for the same seed, in any number of processes
+        generator = NGramGenerator(ngram, seed=1)
+        self.assertEqual(list(generator.generate_sents(25, batch_size=4)),
+                         sents)
+        self.assertEqual(list(generator.generate_sents(25, batch_size=4,
+                                                       jobs=2)), sents)
+        generator = NGramGenerator(ngram, seed=2)
+        self.assertNotEqual(list(generator.generate_sents(25, batch_size=4)),
+                            sents)
+
+    def test_top_k_top_p(self):
+        ngram = NGram(1, self.sents)
+        likely = {'come', '.', '</s>'}  # 2 / 12 each
+
+        for options in [{'top_k': 3}, {'top_p': 0.4}, {'top_p': 0.45},
+                        {'top_k': 3, 'temperature': 5.}]:
+            generator = NGramGenerator(ngram, seed=0, **options)
+            tokens = {generator.generate_token() for i in range(200)}
+            self.assertEqual(tokens, likely, options)
+
+        generator = NGramGenerator(ngram, seed=0, top_k=1)
+        self.assertEqual(generator.generate_token(), '.')
+
+    def test_truncated_smoothed(self):
+        # the options keep the probability of the unseen tokens
+        models = [
+            AddOneNGram(2, self.sents),
+            InterpolatedNGram(3, self.sents, gamma=2.0, addone=False),
+            BackOffNGram(2, self.sents, beta=0.5),
+        ]
+        tokens = ['el', 'gato', 'come', 'pescado', '.', '</s>', 'la', 'gata',
+                  'salmón']
+        for ngram in models:
+            prev_tokens = ('<s>',) * (ngram.n - 2) + ('come',)
+            for options in [{'temperature': 1.0001}, {'top_k': 20}]:
+                generator = NGramGenerator(ngram, seed=0, **options)
+                counts = dict.fromkeys(tokens, 0)
+                for i in range(5000):
+                    counts[generator.generate_token(prev_tokens)] += 1
+                for token in tokens:
+                    prob = ngram.cond_prob(token, prev_tokens)
+                    self.assertAlmostEqual(counts[token] / 5000., prob,
+                                           delta=0.02)
+
+        generator = NGramGenerator(models[0], top_p=1.)
+        self.assertFalse(generator.truncated())
+
+    def test_top_k_unseen(self):
+        # 'pescado' and 'salmón' are seen after 'come', then '</s>' is the
+        # most frequent unigram (tied with '.' and 'come', but a lower id)
+        ngram = BackOffNGram(2, self.sents, beta=0.5)
+        generator = NGramGenerator(ngram, seed=0, top_k=3)
+        tokens = {generator.generate_token(('come',)) for i in range(200)}
+        self.assertEqual(tokens, {'pescado', 'salmón', '</s>'})
+
+    def test_temperature(self):
+        ngram = NGram(2, self.sents + ['el gato come salmón .'.split()])
+        generator = NGramGenerator(ngram, seed=0, temperature=0.5)
+
+        # probabilities 2/3 and 1/3 become 4/5 and 1/5
+        counts = {'salmón': 0, 'pescado': 0}
+        for i in range(5000):
+            counts[generator.generate_token(('come',))] += 1
+        self.assertAlmostEqual(counts['salmón'] / 5000., 0.8, delta=0.02)
+
+    def test_beam_search(self):
+        ngram = NGram(2, self.sents)
+        generator = NGramGenerator(ngram)
+
+        completions = generator.beam_search(['el'], k=3)
+        self.assertEqual(sorted(completions), [
+            ('gato come pescado .'.split(), -1.0),
+            ('gato come salmón .'.split(), -1.0),
+        ])
+
+        completions = generator.beam_search(k=2)
+        self.assertEqual(len(completions), 2)
+        for tokens, logp in completions:
+            self.assertEqual(logp, -2.0)
+            self.assertEqual(logp, ngram.sent_log_prob(tokens))
+
+        self.assertEqual(generator.beam_search(['el'], max_len=3), [])
+        self.assertEqual(generator.beam_search(['perro']), [])
+
+    def test_beam_search_unseen_context(self):
+        ngram = BackOffNGram(3, self.sents, beta=0.5)
+        generator = NGramGenerator(ngram)
+
+        # ('gato', 'salmón') is unseen, ('salmón',) is followed by '.'
+        completions = generator.beam_search(['gato', 'salmón'], k=1)
+        self.assertEqual(len(completions), 1)
+        tokens, logp = completions[0]
+        self.assertEqual(tokens, ['.'])
+        prob = ngram.cond_prob('.', ('gato', 'salmón')) * \
+            ngram.cond_prob('</s>', ('salmón', '.'))
+        self.assertAlmostEqual(2 ** logp, prob)
+
+    def test_beam_search_order(self):
+        sents = self.sents + ['el gato come salmón .'.split()]
+        ngram = NGram(2, sents)
+        generator = NGramGenerator(ngram)
+
+        # after 'come', 'salmón' has probability 2/3 and 'pescado' 1/3
+        completions = generator.beam_search(['el', 'gato'], k=2, beam_width=1)
+        self.assertEqual(len(completions), 1)
+        tokens, logp = completions[0]
+        self.assertEqual(tokens, 'come salmón .'.split())
+        self.assertAlmostEqual(2 ** logp, 2 / 3.)
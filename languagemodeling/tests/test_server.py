@@ -0,0 +1,116 @@
+# https://docs.python.org/3/library/unittest.html
+from unittest import TestCase
+import asyncio
+import json
+import os.path
+import tempfile
+
+from languagemodeling.ngram import BackOffNGram
+from languagemodeling.server import ScoringServer
+
+
+async def request(reader, writer, method, path, data=None):
+    body = b'' if data is None else json.dumps(data).encode('utf-8')
+    head = '%s %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (
+        method, path, len(body))
+    writer.write(head.encode('latin-1') + body)
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if not line.strip():
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return status, json.loads(body.decode('utf-8'))
+
+
+class TestScoringServer(TestCase):
+
+    def setUp(self):
+        self.sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+        ]
+        self.model = BackOffNGram(2, self.sents, beta=0.5)
+        self.model.freeze()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_batching(self):
+        server = ScoringServer(self.model, max_batch=100, max_delay=0.01)
+        requests = [[sent] for sent in self.sents * 5]
+
+        async def run():
+            try:
+                return await asyncio.gather(
+                    *[server.score(sents) for sents in requests])
+            finally:
+                await server.close()
+
+        results = self.loop.run_until_complete(run())
+
+        for sents, scores in zip(requests, results):
+            self.assertEqual(scores, self.model.score_sents(sents))
+        metrics = server.metrics.snapshot()
+        self.assertEqual(metrics['requests'], 10)
+        self.assertEqual(metrics['sentences'], 10)
+        self.assertTrue(metrics['batches'] < 10)
+
+    def test_close(self):
+        server = ScoringServer(self.model, max_delay=10.)
+
+        async def run():
+            # the first request waits for the batch, the second one queues
+            tasks = [asyncio.ensure_future(server.score([sent]))
+                     for sent in self.sents]
+            await asyncio.sleep(0.01)
+            await server.close()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = self.loop.run_until_complete(run())
+
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+
+    def test_http(self):
+        server = ScoringServer(self.model)
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, 'lm.sock')
+        sents = ['el gato come salmón .', 'la gata come salame .'.split()]
+
+        async def run():
+            listener = await server.start(path=path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            try:
+                # several requests on the same connection
+                score = await request(reader, writer, 'POST', '/score',
+                                      {'sents': sents})
+                bad = await request(reader, writer, 'POST', '/score',
+                                    {'sentences': sents})
+                metrics = await request(reader, writer, 'GET', '/metrics')
+                return score, bad, metrics
+            finally:
+                writer.close()
+                listener.close()
+                await listener.wait_closed()
+                await server.close()
+
+        try:
+            score, bad, metrics = self.loop.run_until_complete(run())
+        finally:
+            tmpdir.cleanup()
+
+        scores = self.model.score_sents([s.split() for s in sents[:1]] +
+                                        sents[1:])
+        self.assertEqual(score[0], 200)
+        self.assertEqual(score[1]['sent_log_probs'], scores.sent_log_probs)
+        self.assertEqual(score[1]['perplexity'], scores.perplexity)
+        self.assertEqual(bad[0], 400)
+        self.assertEqual(metrics[0], 200)
+        self.assertEqual(metrics[1]['requests'], 1)
+        self.assertEqual(metrics[1]['errors'], 1)
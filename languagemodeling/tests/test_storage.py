@@ -0,0 +1,104 @@
+# https://docs.python.org/3/library/unittest.html
+from unittest import TestCase
+import os.path
+import tempfile
+
+from languagemodeling.counts import Vocabulary, CountTable
+from languagemodeling.ngram import NGram, AddOneNGram, InterpolatedNGram, \
+    BackOffNGram
+from languagemodeling.storage import save_model, load_model
+
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        self.sents = [
+            'el gato come pescado .'.split(),
+            'la gata come salmón .'.split(),
+        ]
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'model.lm')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_load(self):
+        models = [
+            NGram(2, self.sents),
+            AddOneNGram(3, self.sents),
+            InterpolatedNGram(3, self.sents, gamma=1.0),
+            BackOffNGram(3, self.sents, beta=0.5),
+            BackOffNGram(2, self.sents, addone=False),
+        ]
+        models[-1].finalize()
+        tokens = ['el', 'gato', 'come', 'salmón', '.', '</s>', 'salame']
+
+        for model in models:
+            model.save(self.filename)
+            loaded = NGram.load(self.filename)
+
+            self.assertEqual(type(loaded), type(model))
+            self.assertEqual(loaded.V(), model.V())
+            self.assertEqual(loaded.TABLES, model.TABLES)
+            if isinstance(model, BackOffNGram) and model.alphas is not None:
+                self.assertEqual(dict(loaded.alphas.items()),
+                                 dict(model.alphas.items()))
+            self.assertEqual(dict(loaded.counts.items()),
+                             dict(model.counts.items()))
+            prev_tokens = ('<s>',) * (model.n - 2) + ('come',)
+            for token in tokens:
+                self.assertEqual(loaded.cond_prob(token, prev_tokens),
+                                 model.cond_prob(token, prev_tokens))
+
+    def test_save_over_loaded(self):
+        # a model mapped from a file, saved again to the same file
+        model = BackOffNGram(3, self.sents + self.sents[:1], beta=0.5)
+        model.prune({2: 2})
+        model.save(self.filename)
+        loaded = NGram.load(self.filename)
+        model.update(self.sents)
+        loaded.update(self.sents)
+        loaded.save(self.filename)
+        saved = NGram.load(self.filename)
+
+        self.assertEqual(dict(saved.pruned.items()),
+                         dict(model.pruned.items()))
+        self.assertEqual(dict(saved.counts.items()),
+                         dict(model.counts.items()))
+        self.assertEqual(os.listdir(self.tmpdir.name), ['model.lm'])
+
+    def test_parallel_score_sents(self):
+        model = BackOffNGram(3, self.sents, beta=0.5)
+        model.save(self.filename)
+        loaded = NGram.load(self.filename)
+
+        # the mapped model is shared with the workers, not pickled
+        sents = self.sents * 3
+        self.assertEqual(loaded.parallel_score_sents(sents, shard_size=2),
+                         model.score_sents(sents))
+
+    def test_wide_keys(self):
+        # 17 bits per id, 4-grams don't fit in 64 bits
+        vocab = Vocabulary(str(i) for i in range(2 ** 17))
+        counts = {
+            (1, 2, 3, 4): 5,
+            (2 ** 17 - 1, 0, 1, 2): 2,
+            (1, 2, 3, 5): 1,
+            (7,): 3,
+        }
+        table = CountTable(vocab, counts)
+        save_model(self.filename, 'NGram', {}, vocab, {'counts': table})
+        _, _, vocab2, tables = load_model(self.filename)
+        table2 = tables['counts']
+
+        self.assertEqual(len(vocab2), len(vocab))
+        for ids, c in counts.items():
+            self.assertEqual(table2.get(ids), c)
+        self.assertEqual(table2.get((1, 2, 3, 6)), 0)
+        self.assertEqual(dict(table2.successors((1, 2, 3))), {4: 5, 5: 1})
+
+    def test_bad_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a model' * 10)
+        with self.assertRaises(ValueError):
+            NGram.load(self.filename)